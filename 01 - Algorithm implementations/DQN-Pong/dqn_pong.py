@@ -1,14 +1,24 @@
 from lib import wrappers
 from lib import dqn_model
-
+from lib import replay
+from lib import checkpoint
+from lib.profiler import profiler
+from lib.policy_server import PolicyClient
+from dqn_pong_play import play_episode
+
+import os
+import sys
+import atexit
 import argparse
 import time
+import queue
+import threading
 import numpy as np
-import collections
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
 
 from tensorboardX import SummaryWriter
 
@@ -18,7 +28,7 @@ MEAN_REWARD_BOUND = 19.0
 
 GAMMA = 0.99
 BATCH_SIZE = 32
-REPLAY_SIZE = 10000
+REPLAY_SIZE = 1000000
 REPLAY_START_SIZE = 10000
 LEARNING_RATE = 1e-4
 # How frequently we sync model weights from the training model to the target
@@ -28,37 +38,31 @@ SYNC_TARGET_FRAMES = 1000
 EPSILON_DECAY_LAST_FRAME = 150000
 EPSILON_START = 1.0
 EPSILON_FINAL = 0.01
-'''
-We define our experience replay buffer to keep the transitions obtained from
-the environment each time we take a step. For training we randomly sample the
-batch of transitions from the replay buffer, which allows us to break the
-correlation between subsequent steps in the environment.
-'''
-
-Experience = collections.namedtuple(
-    'Experience',
-    field_names=['state', 'action', 'reward', 'done', 'new_state'])
-
-
-class ExperienceBuffer:
-    def __init__(self, capacity):
-        self.buffer = collections.deque(maxlen=capacity)
 
-    def __len__(self):
-        return len(self.buffer)
+# Prioritized replay: how much the priorities are used (0 is uniform) and the
+# importance-sampling exponent, annealed from BETA_START to 1 over BETA_FRAMES.
+PRIO_REPLAY_ALPHA = 0.6
+BETA_START = 0.4
+BETA_FRAMES = 100000
 
-    def append(self, experience):
-        self.buffer.append(experience)
+# Asynchronous mode: how many gradient steps the learner makes before
+# publishing its weights to the actor process.
+ACTOR_SYNC_UPDATES = 100
+# How often (in seconds) the throughput and the stage timings are reported.
+THROUGHPUT_REPORT_SECONDS = 10
+# How often (in frames) the full training state is checkpointed, and how many
+# of these checkpoints are kept besides the best one.
+CHECKPOINT_FRAMES = 100000
+CHECKPOINT_KEEP = 3
+# Background evaluation: episodes played on each weight snapshot, with random
+# actions as in dqn_pong_eval.py.
+EVAL_EPISODES = 5
+EVAL_EPSILON = 0.05
 
-    def sample(self, batch_size):
-        indices = np.random.choice(len(self.buffer), batch_size, replace=False)
-        states, actions, rewards, dones, next_states = \
-            zip(*[self.buffer[idx] for idx in indices])
 
-        return np.array(states), np.array(actions), \
-            np.array(rewards, dtype=np.float32), \
-            np.array(dones, dtype=np.uint8), \
-            np.array(next_states)
+def calc_epsilon(frame_idx):
+    return max(EPSILON_FINAL,
+               EPSILON_START - frame_idx / EPSILON_DECAY_LAST_FRAME)
 
 
 class Agent:
@@ -68,27 +72,36 @@ class Agent:
         self._reset()
 
     def _reset(self):
-        self.state = env.reset()
+        self.state = self.env.reset()
         self.total_reward = 0.0
 
     @torch.no_grad()
     def play_step(self, net, epsilon=0.0, device="cpu"):
+        """Play one step with the greedy actions of `net`, a model or a
+        PolicyClient. Returns the reward of the episode if it ended."""
         done_reward = None
 
         if np.random.random() < epsilon:
-            action = env.action_space.sample()
+            action = self.env.action_space.sample()
         else:
-            state_a = np.array([self.state], copy=False)
-            state_t = torch.tensor(state_a).to(device)
-            q_vals_t = net(state_t)
-            _, act_t = torch.max(q_vals_t, dim=1)
-            action = int(act_t.item())
-
-        state_, reward, done, _ = self.env.step(action)
+            with profiler.stage("action_forward"):
+                if isinstance(net, PolicyClient):
+                    action = net.act(self.state)
+                else:
+                    state_a = np.array([self.state], copy=False)
+                    state_t = torch.tensor(state_a).to(device)
+                    q_vals_t = net(state_t)
+                    _, act_t = torch.max(q_vals_t, dim=1)
+                    action = int(act_t.item())
+
+        # The emulator's own time goes to the nested "env_step" stage.
+        with profiler.stage("preprocess"):
+            state_, reward, done, _ = self.env.step(action)
         self.total_reward += reward
 
-        exp = Experience(self.state, action, reward, done, state_)
-        self.exp_buffer.append(exp)
+        exp = replay.Experience(self.state, action, reward, done, state_)
+        with profiler.stage("replay_append"):
+            self.exp_buffer.append(exp)
         self.state = state_
 
         if done:
@@ -97,35 +110,559 @@ class Agent:
         return done_reward
 
 
-def calc_loss(batch, net, tgt_net, device="cpu"):
+class VecAgent:
+    def __init__(self, vec_env, exp_buffer, overlap=False):
+        """Agent playing all the envs of a wrappers.SubprocVecEnv at once,
+        each env appending to its own stream of the replay buffer.
+
+        With `overlap`, the envs are split in two groups which ping-pong:
+        the actions of one group are computed while the other one's envs
+        step in their workers, hiding the shorter of the two latencies.
+        """
+        self.env = vec_env
+        self.exp_buffer = exp_buffer
+        self.state = np.array(vec_env.reset())
+        self.total_rewards = np.zeros(vec_env.n_envs)
+        self.actions = np.zeros(vec_env.n_envs, dtype=np.int64)
+        half = vec_env.n_envs // 2
+        self.groups = (slice(0, half), slice(half, vec_env.n_envs))
+        self.overlap = overlap
+        # Whether the first group is being stepped, in overlapped mode.
+        self._in_flight = False
+
+    @torch.no_grad()
+    def _act(self, net, epsilon, device, envs):
+        """Choose the actions of the envs, the greedy ones with a single
+        forward pass."""
+        state = self.state[envs]
+        actions = self.actions[envs]
+        actions[:] = np.random.randint(self.env.action_space.n,
+                                       size=len(state))
+        greedy = np.random.random(len(state)) >= epsilon
+        if greedy.any():
+            with profiler.stage("action_forward"):
+                state_t = torch.from_numpy(state[greedy]).to(device)
+                q_vals_t = net(state_t)
+                _, act_t = torch.max(q_vals_t, dim=1)
+                actions[greedy] = act_t.cpu().numpy()
+        return actions
+
+    def _step_wait(self, envs):
+        """Wait for the envs to step and store their transitions. Returns the
+        rewards of the episodes which ended."""
+        # The workers step and preprocess their envs in this stage.
+        with profiler.stage("vec_env_step"):
+            states_, rewards, dones, infos = self.env.step_wait(envs)
+        state, actions = self.state[envs], self.actions[envs]
+        total_rewards = self.total_rewards[envs]
+        total_rewards += rewards
+
+        done_rewards = []
+        for i, idx in enumerate(range(self.env.n_envs)[envs]):
+            if dones[i]:
+                state_ = infos[i]["terminal_observation"]
+            else:
+                state_ = states_[i]
+            exp = replay.Experience(state[i], actions[i], rewards[i],
+                                    dones[i], state_)
+            with profiler.stage("replay_append"):
+                self.exp_buffer.append(exp, idx)
+            if dones[i]:
+                done_rewards.append(total_rewards[i])
+                total_rewards[i] = 0.0
+        # The vector env overwrites its observations on the next step.
+        state[:] = states_
+        return done_rewards
+
+    def play_step(self, net, epsilon=0.0, device="cpu"):
+        """Play one step in every env, the greedy actions of all of them being
+        chosen with a single forward pass, or one per group in overlapped
+        mode. Returns the rewards of the episodes which ended."""
+        if not self.overlap:
+            self.env.step_async(self._act(net, epsilon, device, slice(None)))
+            return self._step_wait(slice(None))
+
+        first, second = self.groups
+        if not self._in_flight:
+            self.env.step_async(self._act(net, epsilon, device, first),
+                                first)
+        self.env.step_async(self._act(net, epsilon, device, second), second)
+        done_rewards = self._step_wait(first)
+        # The first group steps while the caller trains, until the next call.
+        self.env.step_async(self._act(net, epsilon, device, first), first)
+        self._in_flight = True
+        return done_rewards + self._step_wait(second)
+
+
+def make_agent(env_name, n_envs, exp_buffer, env=None, overlap=False):
+    if n_envs > 1:
+        return VecAgent(wrappers.SubprocVecEnv(env_name, n_envs), exp_buffer,
+                        overlap=overlap)
+    return Agent(env or wrappers.make_env(env_name), exp_buffer)
+
+
+def play_steps(agent, net, epsilon=0.0, device="cpu"):
+    """Play one step with an Agent or a VecAgent and return the list of the
+    rewards of the episodes which ended."""
+    if isinstance(agent, VecAgent):
+        return agent.play_step(net, epsilon, device=device)
+    reward = agent.play_step(net, epsilon, device=device)
+    return [] if reward is None else [reward]
+
+
+class RewardTracker:
+    def __init__(self, writer, env_name, checkpointer, training_state,
+                 solve_on_reward=True):
+        """Log the finished episodes and checkpoint the state returned by
+        `training_state()` whenever the mean reward improves. Without
+        `solve_on_reward`, the mean reward never ends the training."""
+        self.writer = writer
+        self.solve_on_reward = solve_on_reward
+        self.env_name = env_name
+        self.checkpointer = checkpointer
+        self.training_state = training_state
+        self.total_rewards = []
+        self.best_m_reward = None
+        self.ts_frame = 0
+        self.ts = time.time()
+        self.speed = 0.0
+
+    def reward(self, reward, frame_idx, epsilon):
+        """Log a finished episode and save the best checkpoint, and the
+        model alone for dqn_pong_play.py, when the mean reward of the last 100
+        episodes improves. Returns True once it's solved."""
+        self.total_rewards.append(reward)
+        # Several episodes can end on the same frame: the speed is only
+        # measured once frames were played since the previous measure.
+        now = time.time()
+        if frame_idx > self.ts_frame and now > self.ts:
+            self.speed = (frame_idx - self.ts_frame) / (now - self.ts)
+            self.ts_frame = frame_idx
+            self.ts = now
+            self.writer.add_scalar("speed", self.speed, frame_idx)
+        m_reward = np.mean(self.total_rewards[-100:])
+        print("%d: done %d games, reward %.3f, "
+              "eps %.2f, speed %.2f f/s" %
+              (frame_idx, len(self.total_rewards), m_reward, epsilon,
+               self.speed))
+        self.writer.add_scalar("epsilon", epsilon, frame_idx)
+        self.writer.add_scalar("reward_100", m_reward, frame_idx)
+        self.writer.add_scalar("reward", reward, frame_idx)
+        if self.best_m_reward is None or self.best_m_reward < m_reward:
+            if self.best_m_reward is not None:
+                print("Best reward updated %.3f -> %.3f" %
+                      (self.best_m_reward, m_reward))
+            self.best_m_reward = m_reward
+            state = self.training_state()
+            self.checkpointer.save_best(state)
+            self.checkpointer.write(self.env_name + "-best.dat", state["net"])
+        if self.solve_on_reward and m_reward > MEAN_REWARD_BOUND:
+            print("Solved in %d frames!" % frame_idx)
+            return True
+        return False
+
+    def state_dict(self):
+        # Plain floats, numpy scalars can't be loaded with weights_only.
+        return {"total_rewards": [float(r) for r in self.total_rewards],
+                "best_m_reward": None if self.best_m_reward is None
+                else float(self.best_m_reward)}
+
+    def load_state_dict(self, state):
+        self.total_rewards = list(state["total_rewards"])
+        self.best_m_reward = state["best_m_reward"]
+
+
+def play_actor(env_name, n_envs, exp_buffer, net, reward_queue,
+               frame_counter, stop_event, start_frame=0, overlap=False):
+    """Actor process of the asynchronous mode: plays with the weights the
+    learner publishes to `net` and appends the transitions to the shared
+    replay buffer, reporting the finished episodes through `reward_queue`."""
+    torch.set_num_threads(1)
+    # Don't replay the random stream of the learner we were forked from.
+    np.random.seed()
+    agent = make_agent(env_name, n_envs, exp_buffer, overlap=overlap)
+    frame_idx = start_frame
+
+    while not stop_event.is_set():
+        frame_idx += n_envs
+        epsilon = calc_epsilon(frame_idx)
+
+        for reward in play_steps(agent, net, epsilon):
+            reward_queue.put((reward, frame_idx, epsilon))
+        frame_counter.value = frame_idx
+
+
+def eval_worker(env_name, n_episodes, snapshots, results):
+    """Evaluation process: plays `n_episodes` episodes with each weight
+    snapshot received and reports their mean reward."""
+    torch.set_num_threads(1)
+    np.random.seed()
+    env = wrappers.make_env(env_name)
+    net = dqn_model.DQN(env.observation_space.shape, env.action_space.n)
+
+    while True:
+        frame_idx, state = snapshots.get()
+        net.load_state_dict(state)
+        rewards = [play_episode(env, net, epsilon=EVAL_EPSILON)[0]
+                   for _ in range(n_episodes)]
+        results.put((frame_idx, float(np.mean(rewards))))
+
+
+class BackgroundEvaluator:
+    def __init__(self, env_name, every_frames, n_episodes=EVAL_EPISODES):
+        """Evaluate snapshots of the weights in a separate process, at most
+        one every `every_frames` frames. A snapshot is skipped rather than
+        queued while the previous one is being evaluated, so the learner
+        never waits for the evaluation."""
+        self.every_frames = every_frames
+        self.frame_idx = None
+        # Whether a snapshot was submitted and its result not polled yet.
+        self.in_progress = False
+        ctx = mp.get_context("fork")
+        self.snapshots = ctx.Queue(maxsize=1)
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=eval_worker,
+                                   args=(env_name, n_episodes, self.snapshots,
+                                         self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, net, frame_idx):
+        if self.frame_idx is not None and \
+                frame_idx - self.frame_idx < self.every_frames:
+            return
+        if self.in_progress:
+            return
+        self.snapshots.put((frame_idx, checkpoint.snapshot(net.state_dict())))
+        self.frame_idx = frame_idx
+        self.in_progress = True
+
+    def poll(self):
+        """Return the (frame_idx, mean reward) of the finished evaluations.
+        Raises a RuntimeError once the evaluation process died, as no
+        evaluation would finish anymore."""
+        done = []
+        try:
+            while True:
+                done.append(self.results.get_nowait())
+        except queue.Empty:
+            pass
+        if done:
+            self.in_progress = False
+        # The worker only returns once terminated by stop(), it crashed
+        # otherwise.
+        if not done and self.process.exitcode is not None:
+            raise RuntimeError("The evaluation process exited with code %d"
+                               % self.process.exitcode)
+        return done
+
+    def stop(self):
+        # An evaluation in progress is of no use anymore.
+        self.process.terminate()
+        self.process.join()
+
+
+def batch_to_tensors(batch, device="cpu", copy=False):
+    """The batch arrays are exposed to torch without copies, unless `copy`
+    is set for the tensors to outlive the next sample(), which reuses the
+    arrays."""
+    return tuple(torch.from_numpy(arr).to(device, copy=copy)
+                 for arr in batch)
+
+
+def sample_batch(buffer, beta=None, device="cpu", copy=False,
+                 batch_size=BATCH_SIZE):
+    """Sample a batch as tensors, with the indices and importance-sampling
+    weights of the samples when `beta` is given for a prioritized buffer."""
+    with profiler.stage("replay_sample"):
+        if beta is None:
+            return batch_to_tensors(buffer.sample(batch_size), device,
+                                    copy=copy), None, None
+        batch, batch_indices, batch_weights = buffer.sample(batch_size, beta)
+        return batch_to_tensors(batch, device, copy=copy), batch_indices, \
+            torch.from_numpy(batch_weights).to(device)
+
+
+class BatchPrefetcher:
+    def __init__(self, buffer, n_batches, prio=False, device="cpu",
+                 batch_size=BATCH_SIZE):
+        """Sample the next `n_batches` batches and convert them to tensors in
+        a background thread while the learner runs its gradient steps.
+
+        With prioritized replay the batches are sampled with the priorities
+        and the beta of up to `n_batches` steps before they're trained on.
+        """
+        self.buffer = buffer
+        self.prio = prio
+        self.device = device
+        self.batch_size = batch_size
+        self.beta = BETA_START
+        self.queue = queue.Queue(maxsize=n_batches)
+        self._stop = threading.Event()
+        # The exception the thread died of, re-raised by get().
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                item = sample_batch(self.buffer,
+                                    self.beta if self.prio else None,
+                                    device=self.device, copy=True,
+                                    batch_size=self.batch_size)
+                while not self._stop.is_set():
+                    try:
+                        self.queue.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            self._error = e
+
+    def get(self):
+        """Return the next batch, or raise the exception the thread died of
+        once the batches sampled before it are consumed."""
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._error is not None:
+                    raise self._error
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class UpdateScheduler:
+    def __init__(self, replay_ratio):
+        """Number of gradient steps due for the env frames played, at
+        `replay_ratio` steps per frame. The ratio can be fractional, the
+        remainder being carried over to the next frames, or above 1."""
+        self.replay_ratio = replay_ratio
+        self.credit = 0.0
+
+    def step(self, n_frames):
+        self.credit += n_frames * self.replay_ratio
+        n_updates = int(self.credit)
+        self.credit -= n_updates
+        return n_updates
+
+
+def calc_state_action_values(batch, net, tgt_net, gamma=GAMMA):
     '''
     The first model (net) is used to calculate gradients; the second model
     (tgt_net) is used to calculate values for the next states, and this
     calculation shouldn't affect gradients.
-    '''
 
-    states, actions, rewards, dones, states_ = batch
+    For n-step transitions the rewards are already discounted sums and the
+    next state values are discounted by gamma = GAMMA ** n.
+
+    The Q-values are cast to float32 so that under bfloat16 autocast only the
+    models run in bfloat16, not the targets and the loss.
+    '''
 
-    states_t = torch.tensor(np.array(states, copy=False)).to(device)
-    states_t_ = torch.tensor(np.array(states_, copy=False)).to(device)
-    actions_t = torch.LongTensor(actions).to(device)
-    rewards_t = torch.tensor(rewards).to(device)
-    done_mask = torch.BoolTensor(dones).to(device)
+    states_t, actions_t, rewards_t, done_mask, states_t_ = batch
 
     # We pass observations to the first model and extract the specific Q-values
     # for the taken actions.
     state_action_values = net(states_t).gather(
-        1, actions_t.unsqueeze(-1)).squeeze(-1)
+        1, actions_t.unsqueeze(-1)).squeeze(-1).float()
 
     with torch.no_grad():
-        next_state_values = tgt_net(states_t_).max(1)[0]
+        next_state_values = tgt_net(states_t_).max(1)[0].float()
         next_state_values[done_mask] = 0.0
         next_state_values.detach()
 
-    expected_state_action_value = GAMMA * next_state_values + rewards_t
+    expected_state_action_value = gamma * next_state_values + rewards_t
+    return state_action_values, expected_state_action_value
+
+
+def calc_loss(batch, net, tgt_net, gamma=GAMMA):
+    state_action_values, expected_state_action_value = \
+        calc_state_action_values(batch, net, tgt_net, gamma)
     return nn.MSELoss()(state_action_values, expected_state_action_value)
 
 
+def calc_loss_prio(batch, batch_weights, net, tgt_net, gamma=GAMMA):
+    '''
+    MSE loss where each sample is weighted by its importance-sampling weight.
+    Also returns the absolute TD errors used as the new priorities.
+    '''
+    state_action_values, expected_state_action_value = \
+        calc_state_action_values(batch, net, tgt_net, gamma)
+
+    td_errors = expected_state_action_value - state_action_values
+    loss = (batch_weights * td_errors ** 2).mean()
+    return loss, td_errors.detach().abs().cpu().numpy()
+
+
+def train_step(buffer, net, tgt_net, optimizer, frame_idx, prio=False,
+               device="cpu", prefetcher=None, gamma=GAMMA, bf16=False,
+               batch_size=BATCH_SIZE):
+    """One gradient step on a sampled batch. With `bf16`, the forward passes
+    run under bfloat16 autocast while the weights, their gradients and the
+    optimizer state stay float32."""
+    beta = None
+    if prio:
+        beta = min(1.0, BETA_START +
+                   frame_idx * (1.0 - BETA_START) / BETA_FRAMES)
+    if prefetcher is not None:
+        prefetcher.beta = beta
+        batch, batch_indices, batch_weights = prefetcher.get()
+    else:
+        batch, batch_indices, batch_weights = sample_batch(
+            buffer, beta, device=device, batch_size=batch_size)
+
+    with profiler.stage("loss_backward"):
+        optimizer.zero_grad()
+        with torch.autocast(torch.device(device).type, dtype=torch.bfloat16,
+                            enabled=bf16):
+            if prio:
+                loss_t, sample_prios = calc_loss_prio(batch, batch_weights,
+                                                      net, tgt_net, gamma)
+            else:
+                loss_t = calc_loss(batch, net, tgt_net, gamma)
+        loss_t.backward()
+    with profiler.stage("optimizer_step"):
+        optimizer.step()
+    if prio:
+        with profiler.stage("priority_update"):
+            buffer.update_priorities(batch_indices, sample_prios)
+
+
+def np_rng_state():
+    # The key as a list, numpy arrays can't be loaded with weights_only.
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return name, key.tolist(), pos, has_gauss, cached_gaussian
+
+
+def set_np_rng_state(state):
+    name, key, pos, has_gauss, cached_gaussian = state
+    np.random.set_state((name, np.array(key, dtype=np.uint32), pos,
+                         has_gauss, cached_gaussian))
+
+
+class Learner:
+    def __init__(self, args, net, tgt_net, optimizer, buffer, writer,
+                 device="cpu"):
+        """Training state of the learner, and the upkeep which the serial
+        and the asynchronous loops share: starting the prefetcher, syncing
+        the target net, checkpointing and evaluating in the background.
+
+        The loops keep `frame_idx` up to date, the checkpoints of the
+        RewardTracker being taken at that frame.
+        """
+        self.args = args
+        self.net = net
+        self.tgt_net = tgt_net
+        self.optimizer = optimizer
+        self.buffer = buffer
+        self.writer = writer
+        self.device = device
+        # The targets of n-step returns bootstrap from the state n steps
+        # later.
+        self.gamma = GAMMA ** args.n_steps
+        self.frame_idx = 0
+        self.sync_frame = 0
+        self.checkpoint_frame = 0
+        self.checkpointer = checkpoint.Checkpointer(args.checkpoint_dir,
+                                                    keep=CHECKPOINT_KEEP)
+        self.tracker = RewardTracker(writer, args.env, self.checkpointer,
+                                     self.training_state,
+                                     solve_on_reward=not args.solve_on_eval)
+        # Started once the buffer holds REPLAY_START_SIZE transitions.
+        self.prefetcher = None
+        self.evaluator = None
+        # Why the training stopped before being solved, if it did.
+        self.error = None
+        if args.eval_frames:
+            self.evaluator = BackgroundEvaluator(args.env, args.eval_frames)
+
+    def training_state(self):
+        return {"net": self.net.state_dict(),
+                "tgt_net": self.tgt_net.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "frame_idx": self.frame_idx,
+                "sync_frame": self.sync_frame,
+                "epsilon": calc_epsilon(self.frame_idx),
+                "tracker": self.tracker.state_dict(),
+                "np_rng": np_rng_state(),
+                "torch_rng": torch.get_rng_state()}
+
+    def resume(self, path):
+        state = torch.load(path, map_location="cpu")
+        self.net.load_state_dict(state["net"])
+        self.tgt_net.load_state_dict(state["tgt_net"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        self.tracker.load_state_dict(state["tracker"])
+        set_np_rng_state(state["np_rng"])
+        torch.set_rng_state(state["torch_rng"])
+        self.frame_idx = state["frame_idx"]
+        self.sync_frame = state["sync_frame"]
+        self.checkpoint_frame = self.frame_idx
+        self.tracker.ts_frame = self.frame_idx
+
+    def upkeep(self):
+        """Run what's due at `frame_idx` before the gradient steps, once the
+        buffer holds REPLAY_START_SIZE transitions. Returns True once solved
+        on the evaluation reward, or once the evaluation failed, `error`
+        being set then."""
+        args = self.args
+        if args.prefetch and self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(self.buffer, args.prefetch,
+                                              prio=args.prio,
+                                              device=self.device,
+                                              batch_size=args.batch_size)
+        if self.frame_idx - self.sync_frame >= SYNC_TARGET_FRAMES:
+            with profiler.stage("target_sync"):
+                self.tgt_net.load_state_dict(self.net.state_dict())
+            self.sync_frame = self.frame_idx
+        if self.frame_idx - self.checkpoint_frame >= CHECKPOINT_FRAMES:
+            with profiler.stage("checkpoint"):
+                self.checkpointer.save(self.training_state(), self.frame_idx)
+            self.checkpoint_frame = self.frame_idx
+        return self.evaluator is not None and self._poll_evaluator()
+
+    def _poll_evaluator(self):
+        """Submit a snapshot of the weights if one is due and log the
+        finished evaluations. Returns True once solved on them, or once the
+        evaluation process died."""
+        self.evaluator.submit(self.net, self.frame_idx)
+        try:
+            results = self.evaluator.poll()
+        except RuntimeError as e:
+            # Stopped like a solved run, for the loop to write the last
+            # checkpoint before exiting with the error.
+            self.error = str(e)
+            return True
+        solved = False
+        for eval_frame, eval_reward in results:
+            print("%d: eval reward %.3f" % (eval_frame, eval_reward))
+            self.writer.add_scalar("eval_reward", eval_reward, eval_frame)
+            if self.args.solve_on_eval and eval_reward > MEAN_REWARD_BOUND:
+                print("Solved in %d frames!" % eval_frame)
+                solved = True
+        return solved
+
+    def train_step(self):
+        args = self.args
+        train_step(self.buffer, self.net, self.tgt_net, self.optimizer,
+                   self.frame_idx, prio=args.prio, device=self.device,
+                   prefetcher=self.prefetcher, gamma=self.gamma,
+                   bf16=args.bf16, batch_size=args.batch_size)
+
+    def close(self):
+        """Stop the background work and write the last checkpoint."""
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+        if self.evaluator is not None:
+            self.evaluator.stop()
+        self.checkpointer.save(self.training_state(), self.frame_idx)
+        self.checkpointer.close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--cuda",
@@ -136,9 +673,101 @@ if __name__ == "__main__":
                         default=DEFAULT_ENV_NAME,
                         help="Name of the environment, default=" +
                         DEFAULT_ENV_NAME)
+    parser.add_argument("--prio",
+                        default=False,
+                        action="store_true",
+                        help="Use prioritized experience replay")
+    parser.add_argument("--async-actor",
+                        default=False,
+                        action="store_true",
+                        help="Play in a separate actor process while "
+                        "training")
+    parser.add_argument("--envs",
+                        default=1,
+                        type=int,
+                        help="Number of envs played in parallel by worker "
+                        "processes, default=1")
+    parser.add_argument("--overlap",
+                        default=False,
+                        action="store_true",
+                        help="Step two groups of envs in turn, each one "
+                        "while the actions of the other are computed")
+    parser.add_argument("--prefetch",
+                        default=0,
+                        type=int,
+                        help="Number of batches sampled ahead by a "
+                        "background thread, default=0 (disabled)")
+    parser.add_argument("--replay-dir",
+                        help="Keep the replay buffer in memory-mapped files "
+                        "of this directory, reusing the transitions already "
+                        "stored there")
+    parser.add_argument("--compress",
+                        default=False,
+                        action="store_true",
+                        help="Store the replay frames zlib-compressed")
+    parser.add_argument("--n-steps",
+                        default=1,
+                        type=int,
+                        help="Number of steps of the returns the Q-values "
+                        "are trained on, default=1")
+    parser.add_argument("--replay-ratio",
+                        type=float,
+                        help="Gradient steps per env frame, fractional or "
+                        "above 1, default=1 or as many as the learner can "
+                        "make with --async-actor")
+    parser.add_argument("--batch-size",
+                        default=BATCH_SIZE,
+                        type=int,
+                        help="Batch size, default=%d" % BATCH_SIZE)
+    parser.add_argument("--scale-lr",
+                        default=False,
+                        action="store_true",
+                        help="Scale the learning rate linearly with the "
+                        "batch size")
+    parser.add_argument("--bf16",
+                        default=False,
+                        action="store_true",
+                        help="Train with bfloat16 autocast, the run being "
+                        "named apart from the float32 ones")
+    parser.add_argument("--eval-frames",
+                        default=0,
+                        type=int,
+                        help="Evaluate the weights in a background process "
+                        "every this many frames, default=0 (disabled)")
+    parser.add_argument("--solve-on-eval",
+                        default=False,
+                        action="store_true",
+                        help="Stop once the evaluation reward, rather than "
+                        "the mean training reward, reaches the bound")
+    parser.add_argument("--profile",
+                        default=False,
+                        action="store_true",
+                        help="Time the stages of the training loop")
+    parser.add_argument("--checkpoint-dir",
+                        help="Directory of the training checkpoints, "
+                        "default=<env>-checkpoints")
+    parser.add_argument("--resume",
+                        help="Resume training from this checkpoint, or from "
+                        "the latest checkpoint of this directory")
 
     args = parser.parse_args()
+    if args.overlap and args.envs < 2:
+        parser.error("--overlap needs at least 2 --envs")
+    if args.solve_on_eval and not args.eval_frames:
+        parser.error("--solve-on-eval needs --eval-frames")
+    if args.compress and (args.async_actor or args.replay_dir):
+        parser.error("--compress can't be used with --async-actor or "
+                     "--replay-dir")
     device = torch.device("cuda" if args.cuda else "cpu")
+    if args.checkpoint_dir is None:
+        args.checkpoint_dir = args.env + "-checkpoints"
+    resume_path = args.resume
+    if resume_path is not None and os.path.isdir(resume_path):
+        resume_path = checkpoint.latest_checkpoint(resume_path)
+        if resume_path is None:
+            parser.error("no checkpoint in %s" % args.resume)
+    # Enabled before the envs are made for them to time the emulator.
+    profiler.enabled = args.profile
 
     env = wrappers.make_env(args.env)
     net = dqn_model.DQN(env.observation_space.shape,
@@ -146,59 +775,153 @@ if __name__ == "__main__":
     tgt_net = dqn_model.DQN(env.observation_space.shape,
                             env.action_space.n).to(device)
 
-    writer = SummaryWriter(comment="-" + args.env)
+    writer = SummaryWriter(comment="-" + args.env +
+                           ("-bf16" if args.bf16 else ""))
     print(net)
-
-    buffer = ExperienceBuffer(REPLAY_SIZE)
-    agent = Agent(env, buffer)
-    epsilon = EPSILON_START
-
-    optimizer = optim.Adam(net.parameters(), lr=LEARNING_RATE)
-    total_rewards = []
-    frame_idx = 0
-    ts_frame = 0
-    ts = time.time()
-    best_m_reward = None
-
-    while True:
-        frame_idx += 1
-        epsilon = max(EPSILON_FINAL,
-                      EPSILON_START - frame_idx / EPSILON_DECAY_LAST_FRAME)
-
-        reward = agent.play_step(net, epsilon, device=device)
-        if reward is not None:
-            total_rewards.append(reward)
-            speed = (frame_idx - ts_frame) / (time.time() - ts)
-            ts_frame = frame_idx
-            ts = time.time()
-            m_reward = np.mean(total_rewards[-100:])
-            print("%d: done %d games, reward %.3f, "
-                  "eps %.2f, speed %.2f f/s" %
-                  (frame_idx, len(total_rewards), m_reward, epsilon, speed))
-            writer.add_scalar("epsilon", epsilon, frame_idx)
-            writer.add_scalar("speed", speed, frame_idx)
-            writer.add_scalar("reward_100", m_reward, frame_idx)
-            writer.add_scalar("reward", reward, frame_idx)
-            if best_m_reward is None or best_m_reward < m_reward:
-                torch.save(net.state_dict(),
-                           args.env + "-best_%.0f.dat" % m_reward)
-                if best_m_reward is not None:
-                    print("Best reward updated %.3f -> %.3f" %
-                          (best_m_reward, m_reward))
-                best_m_reward = m_reward
-            if m_reward > MEAN_REWARD_BOUND:
-                print("Solved in %d frames!" % frame_idx)
+    if args.profile:
+        atexit.register(profiler.dump,
+                        os.path.join(writer.logdir, "profile.json"))
+
+    if args.prio:
+        buffer = replay.PrioritizedExperienceBuffer(
+            REPLAY_SIZE, env.observation_space.shape,
+            alpha=PRIO_REPLAY_ALPHA, n_streams=args.envs,
+            shared=args.async_actor, directory=args.replay_dir,
+            compress=args.compress, n_step=args.n_steps, gamma=GAMMA)
+    else:
+        buffer = replay.ExperienceBuffer(REPLAY_SIZE,
+                                         env.observation_space.shape,
+                                         n_streams=args.envs,
+                                         shared=args.async_actor,
+                                         directory=args.replay_dir,
+                                         compress=args.compress,
+                                         n_step=args.n_steps, gamma=GAMMA)
+    if len(buffer) > 0:
+        print("Attached to %d transitions in %s" %
+              (len(buffer), args.replay_dir))
+
+    learning_rate = LEARNING_RATE
+    if args.scale_lr:
+        learning_rate *= args.batch_size / BATCH_SIZE
+    optimizer = optim.Adam(net.parameters(), lr=learning_rate)
+    learner = Learner(args, net, tgt_net, optimizer, buffer, writer,
+                      device=device)
+    tracker = learner.tracker
+    if resume_path is not None:
+        learner.resume(resume_path)
+        print("Resumed from %s at frame %d" % (resume_path, learner.frame_idx))
+    scheduler = None
+    if args.replay_ratio is not None or not args.async_actor:
+        scheduler = UpdateScheduler(args.replay_ratio or 1.0)
+
+    if args.async_actor:
+        # The actor is forked so that it inherits the shared replay buffer.
+        ctx = mp.get_context("fork")
+        act_net = dqn_model.DQN(env.observation_space.shape,
+                                env.action_space.n).share_memory()
+        act_net.load_state_dict(net.state_dict())
+        reward_queue = ctx.Queue()
+        frame_counter = ctx.Value('q', learner.frame_idx, lock=False)
+        stop_event = ctx.Event()
+        actor = ctx.Process(target=play_actor,
+                            args=(args.env, args.envs, buffer, act_net,
+                                  reward_queue, frame_counter, stop_event,
+                                  learner.frame_idx, args.overlap))
+        actor.start()
+
+        update_idx = 0
+        ts_report = time.time()
+        frame_report = learner.frame_idx
+        update_report = 0
+        # Gradient steps the scheduler made due and not made yet.
+        pending = 0
+        scheduled_frame = learner.frame_idx
+        solved = False
+
+        # The actor is stopped whatever ends the loop, an exception not
+        # to leave the script waiting for it at exit.
+        try:
+            while not solved:
+                try:
+                    while not solved:
+                        reward, actor_frame, epsilon = \
+                            reward_queue.get_nowait()
+                        solved = tracker.reward(reward, actor_frame, epsilon)
+                except queue.Empty:
+                    pass
+                frame_idx = learner.frame_idx = frame_counter.value
+                # The actor only returns once stopped, it crashed otherwise:
+                # the training stops with an error once the state is
+                # checkpointed.
+                if actor.exitcode is not None:
+                    break
+
+                if len(buffer) < REPLAY_START_SIZE:
+                    scheduled_frame = frame_idx
+                    time.sleep(0.1)
+                    continue
+                solved = learner.upkeep() or solved
+
+                if scheduler is not None:
+                    pending += scheduler.step(frame_idx - scheduled_frame)
+                    scheduled_frame = frame_idx
+                    if pending == 0:
+                        time.sleep(0.001)
+                        continue
+                    pending -= 1
+
+                learner.train_step()
+                update_idx += 1
+                if update_idx % ACTOR_SYNC_UPDATES == 0:
+                    act_net.load_state_dict(net.state_dict())
+
+                dt = time.time() - ts_report
+                if dt >= THROUGHPUT_REPORT_SECONDS:
+                    writer.add_scalar("frames_per_sec",
+                                      (frame_idx - frame_report) / dt,
+                                      frame_idx)
+                    writer.add_scalar("updates_per_sec",
+                                      (update_idx - update_report) / dt,
+                                      frame_idx)
+                    if args.profile:
+                        profiler.write(writer, frame_idx)
+                    ts_report = time.time()
+                    frame_report = frame_idx
+                    update_report = update_idx
+        finally:
+            stop_event.set()
+            actor.join()
+    else:
+        agent = make_agent(args.env, args.envs, buffer, env=env,
+                           overlap=args.overlap)
+        ts_report = time.time()
+        solved = False
+
+        while not solved:
+            learner.frame_idx += args.envs
+            frame_idx = learner.frame_idx
+            epsilon = calc_epsilon(frame_idx)
+
+            for reward in play_steps(agent, net, epsilon, device=device):
+                solved = tracker.reward(reward, frame_idx, epsilon) or solved
+            if solved:
                 break
 
-        if len(buffer) < REPLAY_START_SIZE:
-            continue
+            if args.profile and \
+                    time.time() - ts_report >= THROUGHPUT_REPORT_SECONDS:
+                profiler.write(writer, frame_idx)
+                ts_report = time.time()
 
-        if frame_idx % SYNC_TARGET_FRAMES == 0:
-            tgt_net.load_state_dict(net.state_dict())
+            if len(buffer) < REPLAY_START_SIZE:
+                continue
+            solved = learner.upkeep() or solved
 
-        optimizer.zero_grad()
-        batch = buffer.sample(BATCH_SIZE)
-        loss_t = calc_loss(batch, net, tgt_net, device=device)
-        loss_t.backward()
-        optimizer.step()
+            for _ in range(scheduler.step(args.envs)):
+                learner.train_step()
+    learner.close()
+    buffer.flush()
     writer.close()
+    if args.async_actor and actor.exitcode:
+        sys.exit("The actor process exited with code %d" % actor.exitcode)
+    if learner.error is not None:
+        sys.exit(learner.error)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from lib import wrappers
+from lib import dqn_model
+from dqn_pong_play import play_episode
+
+DEFAULT_ENV_NAME = "PongNoFrameskip-v4"
+# The emulator is deterministic, without random actions all the episodes of
+# a greedy policy would be the same.
+EVAL_EPSILON = 0.05
+
+# Env and model of each worker process, made once by _init_worker.
+_env = None
+_net = None
+
+
+def _init_worker(model, env_name):
+    global _env, _net
+    torch.set_num_threads(1)
+    _env = wrappers.make_env(env_name)
+    _net = dqn_model.load_model(model, _env.observation_space.shape,
+                                _env.action_space.n)
+
+
+def _run_episode(seed, epsilon):
+    np.random.seed(seed)
+    _env.seed(seed)
+    _env.action_space.seed(seed)
+    return play_episode(_env, _net, epsilon=epsilon)
+
+
+def evaluate(model, env_name=DEFAULT_ENV_NAME, n_episodes=100, n_workers=4,
+             seed=0, epsilon=EVAL_EPSILON):
+    """Play `n_episodes` episodes of a model without rendering, on a pool
+    of `n_workers` processes, episode i being seeded with `seed + i`.
+
+    Returns:
+        dict -- mean, stdev, min and max of the episode rewards, the rewards
+            themselves and the Counter of the actions of all the episodes
+    """
+    ctx = mp.get_context("fork")
+    with ctx.Pool(n_workers, initializer=_init_worker,
+                  initargs=(model, env_name)) as pool:
+        results = pool.starmap(_run_episode,
+                               [(seed + i, epsilon)
+                                for i in range(n_episodes)])
+
+    rewards = np.array([reward for reward, _ in results])
+    actions = collections.Counter()
+    for _, c in results:
+        actions.update(c)
+    return {"mean": float(rewards.mean()),
+            "stdev": float(rewards.std(ddof=1)) if n_episodes > 1 else 0.0,
+            "min": float(rewards.min()),
+            "max": float(rewards.max()),
+            "rewards": rewards.tolist(),
+            "actions": actions}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True,
+                        help="Model, checkpoint or exported model file to "
+                        "evaluate")
+    parser.add_argument("-e", "--env", default=DEFAULT_ENV_NAME,
+                        help="Environment name to use, default=" +
+                             DEFAULT_ENV_NAME)
+    parser.add_argument("-n", "--episodes", default=100, type=int,
+                        help="Number of episodes, default=100")
+    parser.add_argument("-w", "--workers", default=mp.cpu_count(), type=int,
+                        help="Number of worker processes, default=number "
+                        "of cpus")
+    parser.add_argument("--seed", default=0, type=int,
+                        help="Seed of the first episode, default=0")
+    parser.add_argument("--epsilon", default=EVAL_EPSILON, type=float,
+                        help="Probability of a random action, default=" +
+                        str(EVAL_EPSILON))
+    args = parser.parse_args()
+
+    result = evaluate(args.model, args.env, args.episodes, args.workers,
+                      args.seed, args.epsilon)
+    print("Reward over %d episodes: mean %.3f, stdev %.3f, min %.2f, "
+          "max %.2f" % (args.episodes, result["mean"], result["stdev"],
+                        result["min"], result["max"]))
+    print("Action counts:", result["actions"])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+
+import torch
+
+from lib import wrappers
+from lib import dqn_model
+
+DEFAULT_ENV_NAME = "PongNoFrameskip-v4"
+CALIBRATION_BATCH_SIZE = 32
+# Random actions mixed in the calibration episodes, for the observations not
+# to be only the ones of the greedy policy.
+CALIBRATION_EPSILON = 0.05
+
+
+@torch.no_grad()
+def calibration_batches(env, net, n_steps):
+    """Play `n_steps` epsilon-greedy steps with the float model and yield
+    the observations in batches."""
+    state = env.reset()
+    batch = []
+    for _ in range(n_steps):
+        batch.append(np.array(state))
+        if np.random.random() < CALIBRATION_EPSILON:
+            action = env.action_space.sample()
+        else:
+            state_t = torch.from_numpy(batch[-1]).unsqueeze(0)
+            action = int(net(state_t).argmax(dim=1).item())
+        state, _, done, _ = env.step(action)
+        if done:
+            state = env.reset()
+        if len(batch) == CALIBRATION_BATCH_SIZE:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True,
+                        help="Model or checkpoint file to export")
+    parser.add_argument("-o", "--output", required=True,
+                        help="TorchScript file to write")
+    parser.add_argument("-e", "--env", default=DEFAULT_ENV_NAME,
+                        help="Environment name to use, default=" +
+                             DEFAULT_ENV_NAME)
+    parser.add_argument("-q", "--quantize", choices=["dynamic", "static"],
+                        help="Quantize the linear layers (dynamic) or the "
+                        "conv and linear layers (static) to int8")
+    parser.add_argument("--calibration-steps", default=2000, type=int,
+                        help="Steps played to calibrate the static "
+                        "quantization, default=2000")
+    args = parser.parse_args()
+
+    env = wrappers.make_env(args.env)
+    shape = env.observation_space.shape
+    net = dqn_model.load_model(args.model, shape, env.action_space.n)
+
+    calibration = None
+    if args.quantize == "static":
+        calibration = calibration_batches(env, net, args.calibration_steps)
+    exported = dqn_model.export_model(net, shape, quantize=args.quantize,
+                                      calibration=calibration)
+    torch.jit.save(exported, args.output)
+    print("Exported %s to %s" % (args.model, args.output))
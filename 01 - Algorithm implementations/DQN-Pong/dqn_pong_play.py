@@ -8,6 +8,7 @@ import torch
 
 from lib import wrappers
 from lib import dqn_model
+from lib.policy_server import PolicyClient
 
 import collections
 
@@ -15,47 +16,70 @@ DEFAULT_ENV_NAME = "PongNoFrameskip-v4"
 FPS = 25
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-m", "--model", required=True,
-                        help="Model file to load")
-    parser.add_argument("-e", "--env", default=DEFAULT_ENV_NAME,
-                        help="Environment name to use, default=" +
-                             DEFAULT_ENV_NAME)
-    parser.add_argument("-r", "--record", help="Directory for video")
-    parser.add_argument("--no-vis", default=True, dest='vis',
-                        help="Disable visualization",
-                        action='store_false')
-    args = parser.parse_args()
-
-    env = wrappers.make_env(args.env)
-    if args.record:
-        env = gym.wrappers.Monitor(env, args.record)
-    net = dqn_model.DQN(env.observation_space.shape,
-                        env.action_space.n)
-    state = torch.load(args.model, map_location=lambda stg, _: stg)
-    net.load_state_dict(state)
-
+def play_episode(env, net, vis=False, epsilon=0.0):
+    """Play an episode with the greedy actions of `net`, a model or a
+    PolicyClient, or random ones with probability `epsilon`, rendering it at
+    FPS frames per second if `vis`. Returns the total reward and the Counter
+    of the actions."""
     state = env.reset()
     total_reward = 0.0
     c = collections.Counter()
 
     while True:
         start_ts = time.time()
-        if args.vis:
+        if vis:
             env.render()
-        state_v = torch.tensor(np.array([state], copy=False))
-        q_vals = net(state_v).data.numpy()[0]
-        action = np.argmax(q_vals)
+        if epsilon > 0.0 and np.random.random() < epsilon:
+            action = env.action_space.sample()
+        elif isinstance(net, PolicyClient):
+            action = net.act(state)
+        else:
+            state_v = torch.from_numpy(np.array(state)).unsqueeze(0)
+            with torch.no_grad():
+                q_vals = net(state_v).numpy()[0]
+            action = int(np.argmax(q_vals))
         c[action] += 1
         state, reward, done, _ = env.step(action)
         total_reward += reward
         if done:
             break
-        if args.vis:
+        if vis:
             delta = 1/FPS - (time.time() - start_ts)
             if delta > 0:
                 time.sleep(delta)
+    return total_reward, c
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model",
+                        help="Model, checkpoint or exported model file to "
+                        "load")
+    parser.add_argument("-s", "--server",
+                        help="Unix socket of a dqn_pong_server.py to get "
+                        "the actions from instead of a model")
+    parser.add_argument("-e", "--env", default=DEFAULT_ENV_NAME,
+                        help="Environment name to use, default=" +
+                             DEFAULT_ENV_NAME)
+    parser.add_argument("-r", "--record", help="Directory for video")
+    parser.add_argument("--no-vis", default=True, dest='vis',
+                        help="Disable visualization",
+                        action='store_false')
+    args = parser.parse_args()
+    if (args.model is None) == (args.server is None):
+        parser.error("one of --model and --server is required")
+
+    env = wrappers.make_env(args.env)
+    if args.record:
+        env = gym.wrappers.Monitor(env, args.record)
+    if args.server:
+        net = PolicyClient(args.server)
+    else:
+        # A model, a training checkpoint or a dqn_pong_export.py TorchScript.
+        net = dqn_model.load_model(args.model, env.observation_space.shape,
+                                   env.action_space.n)
+
+    total_reward, c = play_episode(env, net, vis=args.vis)
     print("Total reward: %.2f" % total_reward)
     print("Action counts:", c)
     if args.record:
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import argparse
+
+from lib import wrappers
+from lib import dqn_model
+from lib.policy_server import PolicyServer
+
+DEFAULT_ENV_NAME = "PongNoFrameskip-v4"
+DEFAULT_ADDRESS = "/tmp/dqn_pong_policy.sock"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", required=True,
+                        help="Model, checkpoint or exported model file to "
+                        "serve")
+    parser.add_argument("-e", "--env", default=DEFAULT_ENV_NAME,
+                        help="Environment name to use, default=" +
+                             DEFAULT_ENV_NAME)
+    parser.add_argument("-a", "--address", default=DEFAULT_ADDRESS,
+                        help="Unix socket to listen on, default=" +
+                        DEFAULT_ADDRESS)
+    parser.add_argument("--max-batch", default=32, type=int,
+                        help="Largest batch of observations, default=32")
+    parser.add_argument("--max-delay-ms", default=2.0, type=float,
+                        help="Longest wait for a batch to fill up, in "
+                        "milliseconds, default=2")
+    args = parser.parse_args()
+
+    env = wrappers.make_env(args.env)
+    shape = env.observation_space.shape
+    net = dqn_model.load_model(args.model, shape, env.action_space.n)
+    env.close()
+
+    server = PolicyServer(net, shape, args.address,
+                          max_batch=args.max_batch,
+                          max_delay=args.max_delay_ms / 1000.0)
+    print("Serving %s on %s" % (args.model, args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,121 @@
+import os
+import re
+import threading
+import numpy as np
+import torch
+
+CHECKPOINT_PATTERN = re.compile(r"checkpoint-(\d+)\.pt$")
+BEST_NAME = "best.pt"
+
+
+def snapshot(obj):
+    """Copy a training state so that it can be written while training goes
+    on: tensors are cloned to the cpu and containers and arrays copied."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, np.ndarray):
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def latest_checkpoint(directory):
+    """Path of the checkpoint of the latest frame in `directory`, the best
+    checkpoint if there's no other one, or None."""
+    if not os.path.isdir(directory):
+        return None
+    frames = [(int(m.group(1)), name) for name in os.listdir(directory)
+              for m in [CHECKPOINT_PATTERN.match(name)] if m]
+    if frames:
+        return os.path.join(directory, max(frames)[1])
+    best = os.path.join(directory, BEST_NAME)
+    return best if os.path.exists(best) else None
+
+
+class Checkpointer:
+    def __init__(self, directory, keep=3):
+        """Write training checkpoints to `directory` on a background thread.
+
+        The state is snapshotted by the caller's thread, so that only the
+        copy of the tensors is paid there, and written to a temporary file
+        which replaces the checkpoint once complete: an interrupted run never
+        leaves a truncated checkpoint behind. Only the last `keep`
+        checkpoints are kept, besides the best one.
+
+        The trainer never waits for the disk: a state still waiting to be
+        written is replaced by a newer one of the same path, and a pending
+        checkpoint by the next one, so a slow disk skips checkpoints instead.
+        A failed write is reported and the next ones are still attempted.
+        """
+        self.directory = directory
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+        # Path -> (state, rotate) of the writes to do, oldest first.
+        self._pending = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                path = next(iter(self._pending))
+                state, rotate = self._pending.pop(path)
+            try:
+                self._write(path, state)
+                if rotate:
+                    self._rotate()
+            except Exception as e:
+                print("Failed to write %s: %s" % (path, e))
+
+    def _write(self, path, state):
+        tmp_path = path + ".tmp"
+        try:
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _rotate(self):
+        frames = sorted((int(m.group(1)), name)
+                        for name in os.listdir(self.directory)
+                        for m in [CHECKPOINT_PATTERN.match(name)] if m)
+        for _, name in frames[:-self.keep]:
+            os.remove(os.path.join(self.directory, name))
+
+    def _put(self, path, state, rotate):
+        with self._cond:
+            if rotate:
+                for stale in [p for p, (_, r) in self._pending.items() if r]:
+                    del self._pending[stale]
+            self._pending.pop(path, None)
+            self._pending[path] = (state, rotate)
+            self._cond.notify()
+
+    def write(self, path, state):
+        """Write any state to `path`, outside the checkpoint rotation."""
+        self._put(path, snapshot(state), False)
+
+    def save(self, state, frame_idx):
+        self._put(os.path.join(self.directory,
+                               "checkpoint-%d.pt" % frame_idx),
+                  snapshot(state), True)
+
+    def save_best(self, state):
+        self.write(os.path.join(self.directory, BEST_NAME), state)
+
+    def close(self):
+        """Wait for the pending checkpoints to be written."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
@@ -1,3 +1,5 @@
+import copy
+import zipfile
 import torch
 import torch.nn as nn
 import numpy as np
@@ -28,5 +30,90 @@ class DQN(nn.Module):
         return int(np.prod(o.size()))
 
     def forward(self, x):
+        # Observations are uint8 frames, scaled to [0, 1] here.
+        x = x.float() / 255.0
         conv_out = self.conv(x).view(x.size()[0], -1)
-        return self.fc(conv_out)
\ No newline at end of file
+        return self.fc(conv_out)
+
+
+class QuantizableDQN(nn.Module):
+    def __init__(self, net):
+        """DQN with the conv and linear layers fused with their ReLUs and
+        the float/int8 conversions marked, for eager-mode static
+        quantization. Shares the layers of `net`."""
+        super(QuantizableDQN, self).__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.conv = net.conv
+        self.fc = net.fc
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def fuse(self):
+        torch.ao.quantization.fuse_modules(
+            self, [["conv.0", "conv.1"], ["conv.2", "conv.3"],
+                   ["conv.4", "conv.5"], ["fc.0", "fc.1"]], inplace=True)
+
+    def forward(self, x):
+        x = self.quant(x.float() / 255.0)
+        conv_out = torch.flatten(self.conv(x), 1)
+        return self.dequant(self.fc(conv_out))
+
+
+def export_model(net, input_shape, quantize=None, calibration=None):
+    """Export a trained DQN to a frozen TorchScript module for inference.
+
+    Arguments:
+        net {DQN} -- trained model, on the cpu
+        input_shape {tuple} -- shape of an observation
+        quantize {str} -- None, "dynamic" for int8 weights of the linear
+            layers, or "static" for int8 conv and linear layers
+        calibration {iterable} -- batches of uint8 observations the
+            activation ranges are measured on, for "static"
+
+    Returns:
+        torch.jit.ScriptModule -- the frozen model
+    """
+    net = copy.deepcopy(net).eval()
+    if quantize == "dynamic":
+        # Dynamic quantization only covers the linear layers.
+        net = torch.ao.quantization.quantize_dynamic(
+            net, {nn.Linear}, dtype=torch.qint8)
+    elif quantize == "static":
+        net = QuantizableDQN(net).eval()
+        net.fuse()
+        net.qconfig = torch.ao.quantization.get_default_qconfig(
+            torch.backends.quantized.engine)
+        torch.ao.quantization.prepare(net, inplace=True)
+        with torch.no_grad():
+            for batch in calibration:
+                net(torch.as_tensor(batch))
+        torch.ao.quantization.convert(net, inplace=True)
+    elif quantize is not None:
+        raise ValueError("Unknown quantization %r" % quantize)
+
+    example = torch.zeros((1,) + tuple(input_shape), dtype=torch.uint8)
+    with torch.no_grad():
+        scripted = torch.jit.trace(net, example)
+    return torch.jit.freeze(scripted)
+
+
+def is_torchscript(path):
+    # TorchScript archives hold their code, torch.save() ones only data.
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith("/constants.pkl")
+                   for name in archive.namelist())
+
+
+def load_model(path, input_shape, n_actions):
+    """Load an exported TorchScript model, or a DQN from a model or full
+    training checkpoint file, for inference on the cpu."""
+    if is_torchscript(path):
+        return torch.jit.load(path, map_location="cpu")
+    net = DQN(input_shape, n_actions)
+    state = torch.load(path, map_location=lambda stg, _: stg)
+    # Either the model alone or a full training checkpoint.
+    if "net" in state:
+        state = state["net"]
+    net.load_state_dict(state)
+    return net.eval()
@@ -0,0 +1,120 @@
+import time
+import threading
+import numpy as np
+import torch
+from multiprocessing import Pipe, BufferTooShort
+from multiprocessing.connection import Listener, Client, wait
+
+
+class PolicyServer:
+    def __init__(self, net, obs_shape, address, max_batch=32,
+                 max_delay=0.002):
+        """Serve the greedy actions of one model to the PolicyClients which
+        connect to the Unix socket `address`.
+
+        Every client sends one uint8 observation and waits for its action.
+        The observations are gathered in a batch until it holds `max_batch`
+        of them, or `max_delay` seconds after the first one arrived, and
+        all of them are answered with a single forward pass. A client
+        which sends anything else than one observation is disconnected.
+        """
+        self.net = net
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.obs = np.zeros((max_batch,) + tuple(obs_shape), dtype=np.uint8)
+        self.listener = Listener(address, family="AF_UNIX")
+        self.conns = []
+        self._lock = threading.Lock()
+        # Wakes up serve_forever() when a client connects.
+        self._wake_r, self._wake_w = Pipe(duplex=False)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            with self._lock:
+                self.conns.append(conn)
+            self._wake_w.send_bytes(b"")
+
+    def _drop(self, conn):
+        with self._lock:
+            if conn in self.conns:
+                self.conns.remove(conn)
+        conn.close()
+
+    @torch.no_grad()
+    def _answer(self, clients):
+        n = len(clients)
+        obs_t = torch.from_numpy(self.obs[:n])
+        actions = self.net(obs_t).argmax(dim=1).numpy()
+        for idx, conn in enumerate(clients):
+            try:
+                conn.send_bytes(actions[idx:idx + 1])
+            except OSError:
+                self._drop(conn)
+
+    def serve_forever(self):
+        clients = []
+        deadline = None
+        while not self._stop.is_set():
+            with self._lock:
+                conns = list(self.conns)
+            if clients:
+                timeout = max(0.0, deadline - time.perf_counter())
+            else:
+                timeout = 0.1
+            # The clients of the open batch are only read again once they
+            # have been answered, a client which closed in the meantime
+            # being dropped when its answer fails.
+            waiting = [conn for conn in conns if conn not in clients]
+            for conn in wait(waiting + [self._wake_r], timeout):
+                if conn is self._wake_r:
+                    conn.recv_bytes()
+                    continue
+                # The remaining clients are read for the next batch.
+                if len(clients) == self.max_batch:
+                    break
+                obs = self.obs[len(clients)].reshape(-1)
+                try:
+                    size = conn.recv_bytes_into(obs)
+                except (EOFError, OSError, BufferTooShort):
+                    self._drop(conn)
+                    continue
+                if size != obs.nbytes:
+                    self._drop(conn)
+                    continue
+                if not clients:
+                    deadline = time.perf_counter() + self.max_delay
+                clients.append(conn)
+            if clients and (len(clients) == self.max_batch or
+                            time.perf_counter() >= deadline):
+                self._answer(clients)
+                clients = []
+
+    def close(self):
+        self._stop.set()
+        self.listener.close()
+        with self._lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns = []
+
+
+class PolicyClient:
+    def __init__(self, address):
+        """Client of a PolicyServer, to use in place of a local model."""
+        self.conn = Client(address, family="AF_UNIX")
+
+    def act(self, obs):
+        """Greedy action of the server's model for a single observation."""
+        obs = np.ascontiguousarray(obs, dtype=np.uint8)
+        self.conn.send_bytes(obs.reshape(-1))
+        return int(np.frombuffer(self.conn.recv_bytes(), dtype=np.int64)[0])
+
+    def close(self):
+        self.conn.close()
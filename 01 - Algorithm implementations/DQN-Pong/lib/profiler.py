@@ -0,0 +1,144 @@
+import json
+import math
+import time
+import threading
+import numpy as np
+
+# Histogram bins are log-spaced, BINS_PER_DECADE per power of ten from
+# MIN_SECONDS, the first and last bins also counting the samples outside.
+MIN_SECONDS = 1e-7
+BINS_PER_DECADE = 10
+N_BINS = 9 * BINS_PER_DECADE
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bins = np.zeros(N_BINS, dtype=np.int64)
+        # Snapshot at the last write() for the per-interval values.
+        self._last = (0, 0.0, self.bins.copy())
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        b = int((math.log10(max(seconds, MIN_SECONDS)) -
+                 math.log10(MIN_SECONDS)) * BINS_PER_DECADE)
+        self.bins[min(b, N_BINS - 1)] += 1
+
+    @staticmethod
+    def percentile(bins, q):
+        """Estimate the q-th percentile (0 < q <= 1) from histogram bins, as
+        the geometric middle of the bin it falls in."""
+        count = bins.sum()
+        if count == 0:
+            return 0.0
+        b = int(np.searchsorted(np.cumsum(bins), q * count))
+        return MIN_SECONDS * 10 ** ((b + 0.5) / BINS_PER_DECADE)
+
+    def summary(self):
+        return {"count": self.count,
+                "total_s": self.total,
+                "mean_ms": 1e3 * self.total / max(self.count, 1),
+                "min_ms": 1e3 * self.min if self.count else 0.0,
+                "max_ms": 1e3 * self.max,
+                "p50_ms": 1e3 * self.percentile(self.bins, 0.5),
+                "p90_ms": 1e3 * self.percentile(self.bins, 0.9),
+                "p99_ms": 1e3 * self.percentile(self.bins, 0.99)}
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.profiler._enter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler.enabled:
+            self.profiler._exit(self.name)
+        return False
+
+
+class StageProfiler:
+    def __init__(self):
+        """Time the stages of the training loop into running histograms.
+
+        Stages are used as `with profiler.stage("name"):` and can be nested:
+        a stage is only charged the time not spent in its nested stages, so
+        that the stages add up to the time of the loop. Each thread has its
+        own stack of stages. Nothing is measured until `enabled` is set.
+        """
+        self.enabled = False
+        self.stats = {}
+        self._stages = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages.setdefault(name, _Stage(self, name))
+        return stage
+
+    def _enter(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # Start time and time spent in the nested stages.
+        stack.append([time.perf_counter(), 0.0])
+
+    def _exit(self, name):
+        stack = self._local.stack
+        start, nested = stack.pop()
+        elapsed = time.perf_counter() - start
+        if stack:
+            stack[-1][1] += elapsed
+        self.add(name, elapsed - nested)
+
+    def add(self, name, seconds):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = StageStats()
+            stats.add(seconds)
+
+    def write(self, writer, step):
+        """Write the mean and 99th percentile of each stage since the last
+        call, in milliseconds, to a SummaryWriter."""
+        with self._lock:
+            for name, stats in self.stats.items():
+                count, total, bins = stats._last
+                if stats.count == count:
+                    continue
+                writer.add_scalar("profile/%s_ms" % name,
+                                  1e3 * (stats.total - total) /
+                                  (stats.count - count), step)
+                writer.add_scalar("profile/%s_p99_ms" % name,
+                                  1e3 * stats.percentile(stats.bins - bins,
+                                                         0.99), step)
+                stats._last = (stats.count, stats.total, stats.bins.copy())
+
+    def summary(self):
+        with self._lock:
+            summary = {name: stats.summary()
+                       for name, stats in self.stats.items()}
+        total = sum(s["total_s"] for s in summary.values())
+        for s in summary.values():
+            s["share"] = s["total_s"] / total if total else 0.0
+        return summary
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+# Profiler of the current process, enabled by the training script.
+profiler = StageProfiler()
@@ -0,0 +1,433 @@
+import os
+import json
+import mmap
+import zlib
+import threading
+import collections
+import multiprocessing
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+We define our experience replay buffer to keep the transitions obtained from
+the environment each time we take a step. For training we randomly sample the
+batch of transitions from the replay buffer, which allows us to break the
+correlation between subsequent steps in the environment.
+'''
+
+Experience = collections.namedtuple(
+    'Experience',
+    field_names=['state', 'action', 'reward', 'done', 'new_state'])
+
+
+def zeros(shape, dtype, shared=False, path=None):
+    """Allocate a zeroed array, in anonymous shared memory if `shared` so
+    that the processes forked afterwards read and write the same pages.
+
+    With `path`, the array is a memory-mapped .npy file instead, opened if it
+    already exists and created otherwise. Its pages are shared with the
+    forked processes as well and only read from disk when accessed.
+    """
+    shape = (shape,) if isinstance(shape, int) else tuple(shape)
+    if path is not None:
+        if not os.path.exists(path):
+            return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                             shape=shape)
+        arr = np.lib.format.open_memmap(path, mode='r+')
+        if arr.shape != shape or arr.dtype != dtype:
+            raise ValueError("%s holds a %s %s array, expected %s %s" %
+                             (path, arr.shape, arr.dtype, shape,
+                              np.dtype(dtype)))
+        return arr
+    if not shared:
+        return np.zeros(shape, dtype=dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+class ExperienceBuffer:
+    def __init__(self, capacity, obs_shape, n_streams=1, shared=False,
+                 directory=None, compress=False, decompress_workers=4,
+                 n_step=1, gamma=0.99):
+        """Replay buffer keeping every 84x84 frame only once, as uint8.
+
+        Slot i holds the newest frame of the state of the i-th transition
+        along with its action, reward and done flag. The stack of the last
+        `n_frames` frames is rebuilt from the previous slots at sample time,
+        frames from an earlier episode being replaced by zeros as
+        BufferWrapper does after a reset. The next state of slot i is the
+        stack of slot i + 1, so the most recent slot is never sampled.
+
+        Transitions played in parallel, e.g. by the envs of a vector env, go
+        to separate `n_streams` rings sharing the capacity so that each
+        stream's transitions stay consecutive.
+
+        With `shared`, the storage and the write positions live in shared
+        memory so that an actor process forked after the buffer is created
+        can append while the learner samples, `lock` serializing the two.
+
+        With a `directory`, every array, write positions included, is a
+        memory-mapped file of that directory, described by its replay.json.
+        A buffer created again on the same directory attaches to the stored
+        transitions, which lets a restarted run train right away.
+
+        With `compress`, each frame is stored zlib-compressed instead, Pong
+        frames shrinking by more than 10x, and the frames of a batch are
+        decompressed by a pool of `decompress_workers` threads. Compressed
+        frames are Python objects so they can't be shared or memory-mapped.
+
+        With `n_step` > 1, the transitions are sampled as n-step ones: the
+        reward is the sum of the next n rewards discounted by `gamma`, up to
+        the end of the episode, and the next state the one n steps later.
+        The sums are accumulated as the rewards are appended.
+        """
+        if compress and (shared or directory is not None):
+            raise ValueError("Compressed frames can't be shared or "
+                             "memory-mapped")
+        self.n_streams = n_streams
+        self.stream_capacity = capacity // n_streams
+        self.capacity = self.stream_capacity * n_streams
+        self.n_frames = obs_shape[0]
+        self.shared = shared
+        self.directory = directory
+        self.n_step = n_step
+        self.gamma = gamma
+        self._mapped = []
+        if directory is not None:
+            metadata = {"type": type(self).__name__,
+                        "capacity": self.capacity,
+                        "n_streams": n_streams,
+                        "obs_shape": list(obs_shape)}
+            if n_step > 1:
+                metadata.update(n_step=n_step, gamma=gamma)
+            self._attach(directory, metadata)
+
+        self.frame_shape = tuple(obs_shape[1:])
+        self.compress = compress
+        if compress:
+            zero_frame = zlib.compress(np.zeros(self.frame_shape, np.uint8))
+            self.frames = [zero_frame] * self.capacity
+            self._pool = ThreadPoolExecutor(decompress_workers)
+            self._n_chunks = decompress_workers
+        else:
+            self.frames = self._zeros("frames", (self.capacity,) +
+                                      self.frame_shape, np.uint8)
+        self.actions = self._zeros("actions", self.capacity, np.int64)
+        self.rewards = self._zeros("rewards", self.capacity, np.float32)
+        self.dones = self._zeros("dones", self.capacity, np.bool_)
+        if n_step > 1:
+            # Discounted reward sum of each slot, number of rewards summed so
+            # far and whether the episode ended within them.
+            self.returns = self._zeros("returns", self.capacity, np.float32)
+            self.n_steps = self._zeros("n_steps", self.capacity, np.int64)
+            self.n_dones = self._zeros("n_dones", self.capacity, np.bool_)
+            self._discounts = gamma ** np.arange(n_step)
+        # Write position and number of stored transitions of each stream.
+        self._cursor = self._zeros("cursor", (n_streams, 2), np.int64)
+        self.lock = multiprocessing.RLock() if shared else threading.RLock()
+        self._batch = None
+        # The episodes stored by a previous run were cut short, the next
+        # transition of each stream starts a new one.
+        for stream, (pos, size) in enumerate(self._cursor):
+            if size > 0:
+                newest = stream * self.stream_capacity + \
+                    (pos - 1) % self.stream_capacity
+                self.dones[newest] = True
+                if n_step > 1:
+                    recent = self._shift(newest, -np.arange(n_step))
+                    self.n_dones[recent[self.n_steps[recent] < n_step]] = \
+                        True
+
+    def _attach(self, directory, metadata):
+        """Check that the buffer stored in `directory` has the same layout,
+        or create the directory and its metadata file."""
+        path = os.path.join(directory, "replay.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                stored = json.load(f)
+            if stored != metadata:
+                raise ValueError("Replay buffer in %s was created with %s, "
+                                 "not %s" % (directory, stored, metadata))
+            return
+        os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    def _path(self, name):
+        if self.directory is None:
+            return None
+        return os.path.join(self.directory, name + ".npy")
+
+    def _zeros(self, name, shape, dtype):
+        arr = zeros(shape, dtype, self.shared, self._path(name))
+        if self.directory is not None:
+            self._mapped.append(arr)
+        return arr
+
+    def flush(self):
+        """Write the memory-mapped arrays back to their files."""
+        with self.lock:
+            for arr in self._mapped:
+                arr.flush()
+
+    def __len__(self):
+        return int(self._cursor[:, 1].sum())
+
+    def append(self, experience, stream=0):
+        frame = experience.state[-1]
+        if self.compress:
+            frame = zlib.compress(np.ascontiguousarray(frame), 1)
+        with self.lock:
+            pos, size = self._cursor[stream]
+            slot = stream * self.stream_capacity + pos
+            self.frames[slot] = frame
+            self.actions[slot] = experience.action
+            self.rewards[slot] = experience.reward
+            self.dones[slot] = experience.done
+            if self.n_step > 1:
+                self._accumulate(slot, experience.reward, experience.done)
+            self._cursor[stream, 0] = (pos + 1) % self.stream_capacity
+            self._cursor[stream, 1] = min(size + 1, self.stream_capacity)
+
+    def _accumulate(self, slot, reward, done):
+        """Add the reward of `slot` to the sums of the last n_step slots
+        whose episode goes on and which don't hold n rewards yet."""
+        self.returns[slot] = 0.0
+        self.n_steps[slot] = 0
+        self.n_dones[slot] = False
+        k = np.arange(self.n_step)
+        recent = self._shift(slot, -k)
+        open_ = (self.n_steps[recent] == k) & ~self.n_dones[recent]
+        recent, k = recent[open_], k[open_]
+        self.returns[recent] += self._discounts[k] * reward
+        self.n_steps[recent] = k + 1
+        self.n_dones[recent] = done
+
+    def _shift(self, indices, offset):
+        """Return the slots `offset` steps after the given ones, wrapping
+        around the ring of their stream."""
+        base = indices - indices % self.stream_capacity
+        return base + (indices - base + offset) % self.stream_capacity
+
+    def _valid_ranges(self):
+        """Return the first sampleable position and the number of such
+        positions of each stream.
+
+        Once a stream has wrapped, its oldest slots can't be stacked anymore
+        since their previous frames have been overwritten. The newest n_step
+        slots have no next state yet.
+        """
+        pos, size = self._cursor[:, 0], self._cursor[:, 1]
+        full = size == self.stream_capacity
+        starts = np.where(full, pos + self.n_frames - 1, 0)
+        counts = np.where(full,
+                          self.stream_capacity - self.n_frames -
+                          self.n_step + 1,
+                          np.maximum(size - self.n_step, 0))
+        return starts, counts
+
+    def _is_valid(self, indices):
+        starts, counts = self._valid_ranges()
+        streams = indices // self.stream_capacity
+        return (indices - starts[streams]) % self.stream_capacity < \
+            counts[streams]
+
+    def _batch_arrays(self, batch_size):
+        """Return the arrays sample() fills, allocated once per batch size."""
+        if self._batch is None or len(self._batch[1]) != batch_size:
+            stack_shape = (batch_size, self.n_frames) + self.frame_shape
+            self._batch = (np.zeros(stack_shape, dtype=np.uint8),
+                           np.zeros(batch_size, dtype=np.int64),
+                           np.zeros(batch_size, dtype=np.float32),
+                           np.zeros(batch_size, dtype=np.bool_),
+                           np.zeros(stack_shape, dtype=np.uint8))
+        return self._batch
+
+    def _stack(self, indices, out):
+        """Gather the (batch, n_frames, 84, 84) stacks of the slots in out."""
+        offsets = np.arange(1 - self.n_frames, 1)
+        frame_idx = self._shift(indices[:, None], offsets)
+        # A done flag in slot j means slot j + 1 starts a new episode, so
+        # every frame up to j is masked out of the stack.
+        prev_dones = self.dones[frame_idx[:, :-1]]
+        masked = np.flip(np.logical_or.accumulate(
+            np.flip(prev_dones, axis=1), axis=1), axis=1)
+        # So are the frames before the first slot of a stream not full yet.
+        streams = indices // self.stream_capacity
+        not_full = self._cursor[streams, 1] < self.stream_capacity
+        before_first = (indices % self.stream_capacity)[:, None] + \
+            offsets[:-1] < 0
+        masked |= before_first & not_full[:, None]
+        self._load_frames(frame_idx, out)
+        out[:, :-1][masked] = 0
+
+    def _load_frames(self, frame_idx, out):
+        if not self.compress:
+            np.take(self.frames, frame_idx, axis=0, out=out)
+            return
+        flat_idx = frame_idx.ravel()
+        flat_out = out.reshape((-1,) + self.frame_shape)
+
+        def decompress(chunk):
+            for j in chunk:
+                flat_out[j] = np.frombuffer(
+                    zlib.decompress(self.frames[flat_idx[j]]),
+                    dtype=np.uint8).reshape(self.frame_shape)
+
+        # zlib releases the GIL, so the chunks are decompressed in parallel.
+        chunks = np.array_split(np.arange(len(flat_idx)), self._n_chunks)
+        list(self._pool.map(decompress, chunks))
+
+    def sample(self, batch_size):
+        """Sample a batch of transitions uniformly, with replacement.
+
+        Drawing indices with randint is O(batch_size) where choice without
+        replacement permutes the whole buffer; duplicates are negligible for
+        large buffers. The returned arrays are reused by the next call.
+        """
+        with self.lock:
+            starts, counts = self._valid_ranges()
+            ends = np.cumsum(counts)
+            draws = np.random.randint(ends[-1], size=batch_size)
+            streams = np.searchsorted(ends, draws, side='right')
+            positions = (starts[streams] + draws - ends[streams] +
+                         counts[streams]) % self.stream_capacity
+            return self._gather(streams * self.stream_capacity + positions)
+
+    def _gather(self, indices):
+        states, actions, rewards, dones, next_states = \
+            self._batch_arrays(len(indices))
+        self._stack(indices, states)
+        np.take(self.actions, indices, out=actions)
+        if self.n_step > 1:
+            self._stack(self._shift(indices, self.n_steps[indices]),
+                        next_states)
+            np.take(self.returns, indices, out=rewards)
+            np.take(self.n_dones, indices, out=dones)
+        else:
+            self._stack(self._shift(indices, 1), next_states)
+            np.take(self.rewards, indices, out=rewards)
+            np.take(self.dones, indices, out=dones)
+        return states, actions, rewards, dones, next_states
+
+
+class SumTree:
+    def __init__(self, capacity, shared=False, path=None):
+        """Binary tree stored in a flat array where each node holds the sum of
+        its two children and the leaves hold the priorities.
+
+        Node i has its children at 2i and 2i + 1 and the root is node 1. The
+        number of leaves is rounded up to a power of two so that they are all
+        on the last level, in order.
+        """
+        self.n_leaves = 1
+        while self.n_leaves < capacity:
+            self.n_leaves *= 2
+        self.depth = self.n_leaves.bit_length() - 1
+        self.tree = zeros(2 * self.n_leaves, np.float64, shared, path)
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, indices):
+        return self.tree[indices + self.n_leaves]
+
+    def update(self, indices, priorities):
+        """Set the priorities of the leaves and propagate the sums to the root
+        in O(log n), one tree level at a time for the whole batch."""
+        nodes = np.asarray(indices) + self.n_leaves
+        self.tree[nodes] = priorities
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """Return the leaves whose cumulative priority range contains each of
+        the values, which must lie in [0, total())."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= self.tree[left] * go_right
+            nodes = left + go_right
+        return nodes - self.n_leaves
+
+
+class PrioritizedExperienceBuffer(ExperienceBuffer):
+    def __init__(self, capacity, obs_shape, alpha=0.6, eps=1e-5,
+                 n_streams=1, shared=False, directory=None, compress=False,
+                 decompress_workers=4, n_step=1, gamma=0.99):
+        """Replay buffer sampling the transitions proportionally to their
+        priority, the absolute TD error of their last update raised to the
+        power of alpha.
+
+        New transitions get the highest priority seen so far. The slots that
+        can't be sampled have a priority of zero.
+        """
+        super(PrioritizedExperienceBuffer, self).__init__(
+            capacity, obs_shape, n_streams=n_streams, shared=shared,
+            directory=directory, compress=compress,
+            decompress_workers=decompress_workers, n_step=n_step, gamma=gamma)
+        self.alpha = alpha
+        self.eps = eps
+        self.tree = SumTree(self.capacity, shared=shared,
+                            path=self._path("tree"))
+        if directory is not None:
+            self._mapped.append(self.tree.tree)
+        self._max_priority = self._zeros("max_priority", 1, np.float64)
+        if self._max_priority[0] == 0.0:
+            self._max_priority[0] = 1.0
+
+    def append(self, experience, stream=0):
+        with self.lock:
+            slot = stream * self.stream_capacity + self._cursor[stream, 0]
+            super(PrioritizedExperienceBuffer, self).append(experience,
+                                                            stream)
+            # The slot n_step back has a next state now, the new one hasn't
+            # yet and once the stream is full its oldest slots stack
+            # overwritten frames.
+            size = self._cursor[stream, 1]
+            indices = [self._shift(slot, -self.n_step), slot]
+            priorities = [self._max_priority[0] if size > self.n_step
+                          else 0.0, 0.0]
+            if size == self.stream_capacity:
+                indices += [self._shift(slot, i)
+                            for i in range(1, self.n_frames)]
+                priorities += [0.0] * (self.n_frames - 1)
+            self.tree.update(np.array(indices), np.array(priorities))
+
+    def sample(self, batch_size, beta=0.4):
+        """Sample a batch with one transition drawn from each of batch_size
+        equal segments of the total priority.
+
+        Returns the batch, the indices of the sampled slots to pass to
+        update_priorities() and the importance-sampling weights, normalized
+        by their maximum, correcting the bias of the prioritized sampling.
+        """
+        with self.lock:
+            segment = self.tree.total() / batch_size
+            values = (np.arange(batch_size) +
+                      np.random.random(batch_size)) * segment
+            indices = self.tree.find(values)
+
+            _, counts = self._valid_ranges()
+            probs = self.tree.get(indices) / self.tree.total()
+            weights = (counts.sum() * probs) ** (-beta)
+            weights /= weights.max()
+            batch = self._gather(indices)
+        return batch, indices, weights.astype(np.float32)
+
+    def update_priorities(self, indices, td_errors):
+        """Set the priorities of the sampled slots from their TD errors.
+
+        Slots that can't be sampled anymore, because transitions were
+        appended since the batch was sampled, keep their zero priority.
+        """
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        with self.lock:
+            valid = self._is_valid(indices)
+            self.tree.update(indices[valid], priorities[valid])
+            self._max_priority[0] = max(self._max_priority[0],
+                                        priorities.max())
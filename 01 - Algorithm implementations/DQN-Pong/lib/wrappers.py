@@ -3,6 +3,9 @@ import gym
 import gym.spaces
 import numpy as np
 import collections
+import multiprocessing
+
+from .profiler import profiler
 
 
 class FireResetEnv(gym.Wrapper):
@@ -27,13 +30,23 @@ class FireResetEnv(gym.Wrapper):
         return obs
 
 
+class ProfiledEnv(gym.Wrapper):
+    def step(self, action):
+        """Charge the emulator steps to the "env_step" profiler stage."""
+        with profiler.stage("env_step"):
+            return self.env.step(action)
+
+
 class MaxAndSkipEnv(gym.Wrapper):
     def __init__(self, env=None, skip=4):
-        """Return only every `skip`-th frame"""
+        """Return only every `skip`-th frame, max pooled with the previous one
+        into a preallocated frame which the next step overwrites."""
         super(MaxAndSkipEnv, self).__init__(env)
         # most recent raw observations (for max pooling across time steps)
         self._obs_buffer = collections.deque(maxlen=2)
         self._skip = skip
+        self._max_frame = np.zeros(env.observation_space.shape,
+                                   dtype=env.observation_space.dtype)
 
     def step(self, action):
         total_reward = 0.0
@@ -44,8 +57,11 @@ class MaxAndSkipEnv(gym.Wrapper):
             total_reward += reward
             if done:
                 break
-        max_frame = np.max(np.stack(self._obs_buffer), axis=0)
-        return max_frame, total_reward, done, info
+        if len(self._obs_buffer) == 1:
+            return self._obs_buffer[0], total_reward, done, info
+        np.maximum(self._obs_buffer[0], self._obs_buffer[1],
+                   out=self._max_frame)
+        return self._max_frame, total_reward, done, info
 
     def reset(self):
         """Clear past frame buffer and init. to first obs. from inner env."""
@@ -57,74 +73,183 @@ class MaxAndSkipEnv(gym.Wrapper):
 
 class ProcessFrame84(gym.ObservationWrapper):
     def __init__(self, env=None):
+        """Convert the frames to 84x84 grayscale, channel first for PyTorch.
+
+        The frames stay uint8 and go through preallocated buffers, the
+        returned one being overwritten by the next observation. The scaling
+        to [0, 1] is left to the model.
+        """
         super(ProcessFrame84, self).__init__(env)
         self.observation_space = gym.spaces.Box(
-            low=0, high=255, shape=(84, 84, 1), dtype=np.uint8)
+            low=0, high=255, shape=(1, 84, 84), dtype=np.uint8)
+        self._gray = {210: np.zeros((210, 160), dtype=np.uint8),
+                      250: np.zeros((250, 160), dtype=np.uint8)}
+        self._resized = np.zeros((110, 84), dtype=np.uint8)
+        self._frame = np.zeros((1, 84, 84), dtype=np.uint8)
 
     def observation(self, obs):
-        return ProcessFrame84.process(obs)
-
-    @staticmethod
-    def process(frame):
-        if frame.size == 210 * 160 * 3:
-            img = np.reshape(frame, [210, 160, 3]).astype(
-                np.float32)
-        elif frame.size == 250 * 160 * 3:
-            img = np.reshape(frame, [250, 160, 3]).astype(
-                np.float32)
+        if obs.size == 210 * 160 * 3:
+            img = np.reshape(obs, [210, 160, 3])
+        elif obs.size == 250 * 160 * 3:
+            img = np.reshape(obs, [250, 160, 3])
         else:
             assert False, "Unknown resolution."
-        img = img[:, :, 0] * 0.299 + img[:, :, 1] * 0.587 + \
-            img[:, :, 2] * 0.114
-        resized_screen = cv2.resize(
-            img, (84, 110), interpolation=cv2.INTER_AREA)
-        x_t = resized_screen[18:102, :]
-        x_t = np.reshape(x_t, [84, 84, 1])
-        return x_t.astype(np.uint8)
-
-
-class ImageToPyTorch(gym.ObservationWrapper):
-    def __init__(self, env):
-        super(ImageToPyTorch, self).__init__(env)
-        old_shape = self.observation_space.shape
-        new_shape = (old_shape[-1], old_shape[0], old_shape[1])
-        self.observation_space = gym.spaces.Box(
-            low=0.0, high=1.0, shape=new_shape, dtype=np.float32)
+        # Same luminance weights as before, computed in fixed point by cv2.
+        gray = self._gray[img.shape[0]]
+        cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=gray)
+        cv2.resize(gray, (84, 110), dst=self._resized,
+                   interpolation=cv2.INTER_AREA)
+        self._frame[0] = self._resized[18:102, :]
+        return self._frame
 
-    def observation(self, observation):
-        return np.moveaxis(observation, 2, 0)
 
+class LazyFrames:
+    def __init__(self, frames):
+        """Stack of the last observed frames, kept as references to the frame
+        arrays and only stacked into a (k, 84, 84) array when a consumer asks
+        for it with np.asarray().
 
-class ScaledFloatFrame(gym.ObservationWrapper):
-    def observation(self, obs):
-        return np.array(obs).astype(np.float32) / 255.0
+        The frames are never written again once observed, so consecutive
+        stacks share them and a stack can't change after it's returned.
+        """
+        self._frames = frames
+
+    def __array__(self, dtype=None):
+        stacked = np.stack(self._frames)
+        if dtype is not None:
+            return stacked.astype(dtype)
+        return stacked
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __getitem__(self, idx):
+        return self._frames[idx]
+
+    @property
+    def shape(self):
+        return (len(self._frames),) + self._frames[0].shape
 
 
 class BufferWrapper(gym.ObservationWrapper):
-    def __init__(self, env, n_steps, dtype=np.float32):
+    def __init__(self, env, n_steps, dtype=np.uint8):
         super(BufferWrapper, self).__init__(env)
         self.dtype = dtype
+        self.n_steps = n_steps
         old_space = env.observation_space
         self.observation_space = gym.spaces.Box(
             old_space.low.repeat(n_steps, axis=0),
             old_space.high.repeat(n_steps, axis=0), dtype=dtype)
+        self._zero_frame = np.zeros(old_space.shape[1:], dtype=dtype)
 
     def reset(self):
-        self.buffer = np.zeros_like(
-            self.observation_space.low, dtype=self.dtype)
+        self.frames = [self._zero_frame] * self.n_steps
+        self.idx = 0
         return self.observation(self.env.reset())
 
     def observation(self, observation):
-        self.buffer[:-1] = self.buffer[1:]
-        self.buffer[-1] = observation
-        return self.buffer
+        # Circular index over the last n_steps frames: the new frame replaces
+        # the oldest one instead of shifting the others.
+        self.frames[self.idx] = np.array(observation[0], dtype=self.dtype)
+        self.idx = (self.idx + 1) % self.n_steps
+        return LazyFrames(tuple(self.frames[self.idx:] +
+                                self.frames[:self.idx]))
 
 
 def make_env(env_name):
     env = gym.make(env_name)
+    if profiler.enabled:
+        env = ProfiledEnv(env)
     env = MaxAndSkipEnv(env)
     env = FireResetEnv(env)
     env = ProcessFrame84(env)
-    env = ImageToPyTorch(env)
-    env = BufferWrapper(env, 4)
-    return ScaledFloatFrame(env)
+    return BufferWrapper(env, 4)
+
+
+def _vec_env_worker(remote, env_name, obs, idx):
+    """Run one env of SubprocVecEnv, writing its observations to obs[idx]."""
+    env = make_env(env_name)
+    while True:
+        cmd, action = remote.recv()
+        if cmd == "step":
+            ob, reward, done, info = env.step(action)
+            if done:
+                # The reset observation takes the slot, the last one of the
+                # episode is still needed for its transition.
+                info = dict(info, terminal_observation=np.array(ob))
+                ob = env.reset()
+            obs[idx] = ob
+            remote.send((reward, done, info))
+        elif cmd == "reset":
+            obs[idx] = env.reset()
+            remote.send(None)
+        elif cmd == "close":
+            env.close()
+            remote.close()
+            break
+
+
+class SubprocVecEnv:
+    def __init__(self, env_name, n_envs):
+        """Run `n_envs` copies of the make_env() stack in worker processes.
+
+        The observations of all the envs are written by the workers to a
+        single shared (n_envs, 4, 84, 84) array, `obs`, which step() and
+        reset() return without copying: it is overwritten by the next call.
+        An env is reset as soon as its episode ends and the last observation
+        of the episode is passed in info["terminal_observation"].
+
+        step_async() and step_wait() take an optional slice of the envs, for
+        groups of envs to be stepped independently of each other.
+        """
+        env = make_env(env_name)
+        self.observation_space = env.observation_space
+        self.action_space = env.action_space
+        env.close()
+        self.n_envs = n_envs
+
+        ctx = multiprocessing.get_context("fork")
+        shape = (n_envs,) + self.observation_space.shape
+        dtype = self.observation_space.dtype
+        self._obs_raw = ctx.RawArray(np.ctypeslib.as_ctypes_type(dtype),
+                                     int(np.prod(shape)))
+        self.obs = np.frombuffer(self._obs_raw, dtype=dtype).reshape(shape)
+
+        self.remotes, self.processes = [], []
+        for idx in range(n_envs):
+            remote, worker_remote = ctx.Pipe()
+            process = ctx.Process(target=_vec_env_worker,
+                                  args=(worker_remote, env_name, self.obs,
+                                        idx),
+                                  daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.obs
+
+    def step_async(self, actions, envs=slice(None)):
+        for remote, action in zip(self.remotes[envs], actions):
+            remote.send(("step", int(action)))
+
+    def step_wait(self, envs=slice(None)):
+        results = [remote.recv() for remote in self.remotes[envs]]
+        rewards, dones, infos = zip(*results)
+        return self.obs[envs], np.array(rewards, dtype=np.float32), \
+            np.array(dones, dtype=np.bool_), infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join()
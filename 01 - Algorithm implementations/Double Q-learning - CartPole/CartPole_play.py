@@ -1,22 +1,29 @@
+import os
+import sys
 import numpy as np
 import gym
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir))
+from tabular_cartpole.q_table import QTable  # noqa: E402
+from tabular_cartpole.discretizer import Discretizer  # noqa: E402
+
 
 def action_argmax_q1q2(Q1, Q2, state):
     """Return the action with the maximum value for the current state using
         Q1 + Q2.
 
     Arguments:
-        Q1 {dict} -- state-action function dict Q1
-        Q2 {dict} -- state-action function dict Q2
-        state {array} -- Current state
+        Q1 {QTable} -- state-action function table Q1
+        Q2 {QTable} -- state-action function table Q2
+        state {int} -- Current state
 
     Returns:
         int -- Action to take
     """
-    values = np.array([Q1[state, a] + Q2[state, a] for a in range(N_ACTIONS)])
+    values = Q1.values[state] + Q2.values[state]
     # Random tie breaking
-    action = np.random.choice(np.where(values == values.max())[0])
+    action = np.random.choice(np.flatnonzero(values == values.max()))
     return action
 
 
@@ -25,34 +32,30 @@ pole_theta_space = np.linspace(-0.209, 0.209, 10)
 pole_theta_vel_space = np.linspace(-4, 4, 10)
 cart_pos_space = np.linspace(-2.4, 2.4, 10)
 cart_vel_space = np.linspace(-4, 4, 10)
+discretizer = Discretizer(cart_pos_space, cart_vel_space, pole_theta_space,
+                          pole_theta_vel_space)
 
 
 def get_state(observation):
     """Return the state based on the observation from the env
 
     Arguments:
-        observation {array} -- states from the env.
+        observation {array} -- states from the env, or an (N, 4) batch of
+            them.
 
     Returns:
-        array -- current state
+        int -- flat index of the current state, or array of the N indices
     """
-    cart_x, cart_vel, pole_theta, pole_vel = observation
-    cart_x = int(np.digitize(cart_x, cart_pos_space))
-    cart_vel = int(np.digitize(cart_vel, cart_vel_space))
-    pole_theta = int(np.digitize(pole_theta, pole_theta_space))
-    pole_vel = int(np.digitize(pole_vel, pole_theta_vel_space))
-
-    return (cart_x, cart_vel, pole_theta, pole_vel)
+    return discretizer(observation)
 
 
 if __name__ == '__main__':
 
     env = gym.make('CartPole-v0')
-    N_ACTIONS = env.action_space.n
 
     # Load the trained Q function
-    Q1 = np.load('Q1_values.npy', allow_pickle='TRUE').item()
-    Q2 = np.load('Q2_values.npy', allow_pickle='TRUE').item()
+    Q1 = QTable.load('Q1_values.npy')
+    Q2 = QTable.load('Q2_values.npy')
 
     # Play a game of Cart Pole
     observation = env.reset()
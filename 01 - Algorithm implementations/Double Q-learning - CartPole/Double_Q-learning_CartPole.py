@@ -1,9 +1,17 @@
 # Original code from "Reinforcement Learning in Motion" by Phil Tabor.
 
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import gym
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir))
+from tabular_cartpole.q_table import QTable, random_argmax  # noqa: E402
+from tabular_cartpole.discretizer import Discretizer  # noqa: E402
+from tabular_cartpole.batch_training import train_batched  # noqa: E402
+
 # Gym - CartPole
 #
 # State space:
@@ -22,32 +30,16 @@ def action_argmax_q1q2(Q1, Q2, state):
         Q1 + Q2.
 
     Arguments:
-        Q1 {dict} -- state-action function dict Q1
-        Q2 {dict} -- state-action function dict Q2
-        state {array} -- Current state
-
-    Returns:
-        int -- Action to take
-    """
-    values = np.array([Q1[state, a] + Q2[state, a] for a in range(N_ACTIONS)])
-    # Random tie breaking
-    action = np.random.choice(np.where(values == values.max())[0])
-    return action
-
-
-def action_argmax(Q, state):
-    """Return the action with the maximum value for the current state.
-
-    Arguments:
-        Q {dict} -- state-action function dict
-        state {array} -- Current state
+        Q1 {QTable} -- state-action function table Q1
+        Q2 {QTable} -- state-action function table Q2
+        state {int} -- Current state
 
     Returns:
         int -- Action to take
     """
-    values = np.array([Q[state, a] for a in range(N_ACTIONS)])
+    values = Q1.values[state] + Q2.values[state]
     # Random tie breaking
-    action = np.random.choice(np.where(values == values.max())[0])
+    action = np.random.choice(np.flatnonzero(values == values.max()))
     return action
 
 
@@ -56,24 +48,21 @@ pole_theta_space = np.linspace(-0.209, 0.209, 10)
 pole_theta_vel_space = np.linspace(-4, 4, 10)
 cart_pos_space = np.linspace(-2.4, 2.4, 10)
 cart_vel_space = np.linspace(-4, 4, 10)
+discretizer = Discretizer(cart_pos_space, cart_vel_space, pole_theta_space,
+                          pole_theta_vel_space)
 
 
 def get_state(observation):
     """Return the state based on the observation from the env
 
     Arguments:
-        observation {array} -- states from the env.
+        observation {array} -- states from the env, or an (N, 4) batch of
+            them.
 
     Returns:
-        array -- current state
+        int -- flat index of the current state, or array of the N indices
     """
-    cart_x, cart_vel, pole_theta, pole_vel = observation
-    cart_x = int(np.digitize(cart_x, cart_pos_space))
-    cart_vel = int(np.digitize(cart_vel, cart_vel_space))
-    pole_theta = int(np.digitize(pole_theta, pole_theta_space))
-    pole_vel = int(np.digitize(pole_vel, pole_theta_vel_space))
-
-    return (cart_x, cart_vel, pole_theta, pole_vel)
+    return discretizer(observation)
 
 
 def plot_running_avg(total_rewards):
@@ -91,6 +80,30 @@ def plot_running_avg(total_rewards):
     plt.show()
 
 
+def batch_update(Q1, Q2, alpha, gamma):
+    """Return the Double Q-learning update of train_batched.
+
+    Arguments:
+        Q1 {QTable} -- state-action function table Q1
+        Q2 {QTable} -- state-action function table Q2
+        alpha {float} -- Step size
+        gamma {float} -- Discount factor
+
+    Returns:
+        function -- Update of Q1 or Q2 from a batch of transitions
+    """
+    def update(state, action, reward, state_, action_, eps, random):
+        # Update Q1 or Q2 based on a 50% probability
+        first = random() <= 0.5
+        keys = random(Q1.n_actions)
+        for Qa, Qb, envs in ((Q1, Q2, first), (Q2, Q1, ~first)):
+            action_ = random_argmax(Qa.values[state_[envs]], keys[envs])
+            Qa.update_batch(state[envs], action[envs],
+                            reward[envs] +
+                            gamma * Qb.values[state_[envs], action_], alpha)
+    return update
+
+
 if __name__ == '__main__':
 
     env = gym.make('CartPole-v0')
@@ -98,72 +111,85 @@ if __name__ == '__main__':
     GAMMA = 1.0
     EPS = 1.0
     N_ACTIONS = env.action_space.n
-
-    # Construct the state space
-    states = []
-    for i in range(len(cart_pos_space) + 1):
-        for j in range(len(cart_vel_space) + 1):
-            for k in range(len(pole_theta_space) + 1):
-                for l in range(len(pole_theta_vel_space) + 1):
-                    states.append((i, j, k, l))
+    # Number of envs played at once by a numpy BatchCartPole, 1 to play the
+    # gym env.
+    N_ENVS = 1
+    # Number of independent agents trained at once, 1 to train a single one.
+    N_SEEDS = 1
+    # Seed of the BatchCartPole runs, the curve of the k-th agent only
+    # depending on SEED and k.
+    SEED = 0
 
     # initialise Q(s,a) to 0
-    Q1, Q2 = {}, {}
-    for state in states:
-        for action in range(N_ACTIONS):
-            Q1[state, action] = 0
-            Q2[state, action] = 0
+    Q1, Q2 = QTable(N_ACTIONS), QTable(N_ACTIONS)
 
     number_games = 25000
-    total_rewards = np.zeros(number_games)
-
-    for i in range(number_games):
-
-        if i % 5000 == 0:
-            print('Starting game', i)
-
-        observation = env.reset()
-        state = get_state(observation)
-
-        done = False
-        ep_rewards = 0
-
-        while not done:
-
-            # e-greedy action selection
-            rand = np.random.random()
-            random_action = env.action_space.sample()
-            action = action_argmax_q1q2(
-                Q1, Q2, state) if rand < (1 - EPS) else random_action
-
-            observation_, reward, done, info = env.step(action)
-            ep_rewards += reward
-            state_ = get_state(observation_)
-            rand = np.random.random()
-
-            # Update Q1 or Q2 based on a 50% probability
-            if rand <= 0.5:
-                action_ = action_argmax(Q1, state_)
-                Q1[state, action] = Q1[state, action] + ALPHA * (
-                    reward + GAMMA * Q2[state_, action_] - Q1[state, action])
-            elif rand > 0.5:
-                action_ = action_argmax(Q2, state_)
-                Q2[state, action] = Q2[state, action] + ALPHA * (
-                    reward + GAMMA * Q1[state_, action_] - Q2[state, action])
-            state = state_
-
-        # At the end of the episode decrease epsilon by a small amount such as
-        # it converges to a greedy strategy through the series of ep.
-        if EPS - 1.5 / number_games > 0:
-            EPS -= 1.5 / number_games
-        else:
-            EPS = 0
-
-        total_rewards[i] = ep_rewards
-
-    # Save the Q dictionnary to be played back.
-    np.save('Q1_values.npy', Q1)
-    np.save('Q2_values.npy', Q2)
+    if N_ENVS > 1 or N_SEEDS > 1:
+        Q1_seeds = QTable(N_ACTIONS, (N_SEEDS,) + Q1.state_shape)
+        Q2_seeds = QTable(N_ACTIONS, (N_SEEDS,) + Q2.state_shape)
+        seed_rewards = train_batched([Q1_seeds, Q2_seeds],
+                                     batch_update(Q1_seeds, Q2_seeds,
+                                                  ALPHA, GAMMA),
+                                     get_state, number_games, EPS,
+                                     1.5 / number_games, n_envs=N_ENVS,
+                                     n_seeds=N_SEEDS, seed=SEED)
+        np.savez('seed_rewards.npz', rewards=seed_rewards, seed=SEED)
+        # Keep the agent of the first seed and the mean learning curve.
+        Q1.table[...] = Q1_seeds.table[0]
+        Q2.table[...] = Q2_seeds.table[0]
+        total_rewards = seed_rewards.mean(axis=0)
+    else:
+        total_rewards = np.zeros(number_games)
+
+        for i in range(number_games):
+
+            if i % 5000 == 0:
+                print('Starting game', i)
+
+            observation = env.reset()
+            state = get_state(observation)
+
+            done = False
+            ep_rewards = 0
+
+            while not done:
+
+                # e-greedy action selection
+                rand = np.random.random()
+                random_action = env.action_space.sample()
+                action = action_argmax_q1q2(
+                    Q1, Q2, state) if rand < (1 - EPS) else random_action
+
+                observation_, reward, done, info = env.step(action)
+                ep_rewards += reward
+                state_ = get_state(observation_)
+                rand = np.random.random()
+
+                # Update Q1 or Q2 based on a 50% probability
+                if rand <= 0.5:
+                    action_ = Q1.argmax(state_)
+                    Q1.update(state, action,
+                              reward + GAMMA * Q2.values[state_, action_],
+                              ALPHA)
+                elif rand > 0.5:
+                    action_ = Q2.argmax(state_)
+                    Q2.update(state, action,
+                              reward + GAMMA * Q1.values[state_, action_],
+                              ALPHA)
+                state = state_
+
+            # At the end of the episode decrease epsilon by a small amount such
+            # as it converges to a greedy strategy through the series of ep.
+            if EPS - 1.5 / number_games > 0:
+                EPS -= 1.5 / number_games
+            else:
+                EPS = 0
+
+            total_rewards[i] = ep_rewards
+
+    # Save the Q tables to be played back.
+    Q1.save('Q1_values.npy')
+    Q2.save('Q2_values.npy')
 
     # Print the running average.
     plot_running_avg(total_rewards)
@@ -1,10 +1,18 @@
 # Original code from "Reinforcement Learning in Motion" by Phil Tabor.
 # Modified for Expected-Sarsa algorithm
 
+import os
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import gym
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir))
+from tabular_cartpole.q_table import QTable  # noqa: E402
+from tabular_cartpole.discretizer import Discretizer  # noqa: E402
+from tabular_cartpole.batch_training import train_batched  # noqa: E402
+
 # Gym - CartPole
 #
 # State space:
@@ -18,45 +26,26 @@ import gym
 # Push right (1)
 
 
-def action_argmax(Q, state):
-    """Return the action with the maximum value for the current state.
-
-    Arguments:
-        Q {dict} -- state-action function array
-        state {array} -- Current state
-
-    Returns:
-        int -- Action to take
-    """
-    values = np.array([Q[state, a] for a in range(N_ACTIONS)])
-    # Random tie breaking
-    action = np.random.choice(np.where(values == values.max())[0])
-    return action
-
-
 # Discretize the state spaces
 pole_theta_space = np.linspace(-0.209, 0.209, 10)
 pole_theta_vel_space = np.linspace(-4, 4, 10)
 cart_pos_space = np.linspace(-2.4, 2.4, 10)
 cart_vel_space = np.linspace(-4, 4, 10)
+discretizer = Discretizer(cart_pos_space, cart_vel_space, pole_theta_space,
+                          pole_theta_vel_space)
 
 
 def get_state(observation):
     """Return the state based on the observation from the env
 
     Arguments:
-        observation {array} -- states from the env.
+        observation {array} -- states from the env, or an (N, 4) batch of
+            them.
 
     Returns:
-        array -- current state
+        int -- flat index of the current state, or array of the N indices
     """
-    cart_x, cart_vel, pole_theta, pole_vel = observation
-    cart_x = int(np.digitize(cart_x, cart_pos_space))
-    cart_vel = int(np.digitize(cart_vel, cart_vel_space))
-    pole_theta = int(np.digitize(pole_theta, pole_theta_space))
-    pole_vel = int(np.digitize(pole_vel, pole_theta_vel_space))
-
-    return (cart_x, cart_vel, pole_theta, pole_vel)
+    return discretizer(observation)
 
 
 def plot_running_avg(total_rewards):
@@ -74,23 +63,39 @@ def plot_running_avg(total_rewards):
     plt.show()
 
 
-def expected_q(state_, Q, pi):
-    """Gives the sum of pi(a|s')*Q(s',a) for each a.
+def expected_q(state_, Q, eps):
+    """Gives the sum of pi(a|s')*Q(s',a) for each a, pi being the e-greedy
+    policy of Q: each action has a probability of eps/n_actions, plus
+    1-eps for the greedy one, so the sum is in closed form.
 
     Arguments:
-        state_ {array} -- State st+1
-        Q {dict} -- Dictionnary of Q(s,a)
-        pi {dict} -- Policy of pi(a|s)
+        state_ {int} -- State st+1, or array of them
+        Q {QTable} -- Table of Q(s,a)
+        eps {float} -- Epsilon, or array of them
 
     Returns:
-        float -- Calculated sum
+        float -- Calculated sum, or array of them
     """
-    expected_q = 0
+    values = Q.values[state_]
+    return (eps / Q.n_actions) * values.sum(axis=-1) + \
+        (1 - eps) * values.max(axis=-1)
 
-    for a in range(N_ACTIONS):
-        expected_q += pi[state_, a] * Q[state_, a]
 
-    return expected_q
+def batch_update(Q, alpha, gamma):
+    """Return the Expected Sarsa update of train_batched.
+
+    Arguments:
+        Q {QTable} -- Table of Q(s,a)
+        alpha {float} -- Step size
+        gamma {float} -- Discount factor
+
+    Returns:
+        function -- Update of Q from a batch of transitions
+    """
+    def update(state, action, reward, state_, action_, eps, random):
+        Q.update_batch(state, action,
+                       reward + gamma * expected_q(state_, Q, eps), alpha)
+    return update
 
 
 if __name__ == '__main__':
@@ -100,73 +105,73 @@ if __name__ == '__main__':
     GAMMA = 1.0
     EPS = 1.0
     N_ACTIONS = env.action_space.n
-
-    # Construct the state space
-    states = []
-    for i in range(len(cart_pos_space) + 1):
-        for j in range(len(cart_vel_space) + 1):
-            for k in range(len(pole_theta_space) + 1):
-                for l in range(len(pole_theta_vel_space) + 1):
-                    states.append((i, j, k, l))
-
-    # initialise Q(s,a) to 0 and pi as equiprobable random policy
-    Q = {}
-    pi = {}
-    for state in states:
-        for action in range(N_ACTIONS):
-            Q[state, action] = 0
-            pi[state, action] = 1 / (N_ACTIONS)
+    # Number of envs played at once by a numpy BatchCartPole, 1 to play the
+    # gym env.
+    N_ENVS = 1
+    # Number of independent agents trained at once, 1 to train a single one.
+    N_SEEDS = 1
+    # Seed of the BatchCartPole runs, the curve of the k-th agent only
+    # depending on SEED and k.
+    SEED = 0
+
+    # initialise Q(s,a) to 0, the policy being e-greedy with respect to Q
+    Q = QTable(N_ACTIONS)
 
     number_games = 15000
-    total_rewards = np.zeros(number_games)
-
-    for i in range(number_games):
-
-        if i % 5000 == 0:
-            print('Starting game', i)
-
-        observation = env.reset()
-        state = get_state(observation)
-
-        done = False
-        ep_rewards = 0
-
-        while not done:
-            # e-greedy action selection
-            rand = np.random.random()
-            random_action = env.action_space.sample()
-            action = action_argmax(
-                pi, state) if rand < (1 - EPS) else random_action
-
-            observation_, reward, done, info = env.step(action)
-            state_ = get_state(observation_)
-
-            # Update Q
-            Q[state,  action] = Q[state, action] + ALPHA * \
-                (reward + GAMMA * expected_q(state_, Q, pi) - Q[state, action])
-
-            # Update policy
-            max_action = action_argmax(Q, state)
-            for a in range(N_ACTIONS):
-                if a == max_action:
-                    pi[state, a] = 1 - EPS + (EPS / N_ACTIONS)
-                else:
-                    pi[state, a] = EPS / N_ACTIONS
-
-            ep_rewards += reward
-            state = state_
-
-        # At the end of the episode decrease epsilon by a small amount such as
-        # it converges to a greedy strategy halfway through the series of ep.
-        if EPS - 2 / number_games > 0:
-            EPS -= 2 / number_games
-        else:
-            EPS = 0
-
-        total_rewards[i] = ep_rewards
-
-    # Save the Q dictionnary to be played back.
-    np.save('Q_values.npy', Q)
+    if N_ENVS > 1 or N_SEEDS > 1:
+        Q_seeds = QTable(N_ACTIONS, (N_SEEDS,) + Q.state_shape)
+        seed_rewards = train_batched([Q_seeds],
+                                     batch_update(Q_seeds, ALPHA, GAMMA),
+                                     get_state, number_games, EPS,
+                                     2 / number_games, n_envs=N_ENVS,
+                                     n_seeds=N_SEEDS, seed=SEED)
+        np.savez('seed_rewards.npz', rewards=seed_rewards, seed=SEED)
+        # Keep the agent of the first seed and the mean learning curve.
+        Q.table[...] = Q_seeds.table[0]
+        total_rewards = seed_rewards.mean(axis=0)
+    else:
+        total_rewards = np.zeros(number_games)
+
+        for i in range(number_games):
+
+            if i % 5000 == 0:
+                print('Starting game', i)
+
+            observation = env.reset()
+            state = get_state(observation)
+
+            done = False
+            ep_rewards = 0
+
+            while not done:
+                # e-greedy action selection
+                rand = np.random.random()
+                random_action = env.action_space.sample()
+                action = Q.argmax(state) if rand < (1 - EPS) \
+                    else random_action
+
+                observation_, reward, done, info = env.step(action)
+                state_ = get_state(observation_)
+
+                # Update Q
+                Q.update(state, action,
+                         reward + GAMMA * expected_q(state_, Q, EPS), ALPHA)
+
+                ep_rewards += reward
+                state = state_
+
+            # At the end of the episode decrease epsilon by a small amount such
+            # as it converges to a greedy strategy halfway through the series
+            # of ep.
+            if EPS - 2 / number_games > 0:
+                EPS -= 2 / number_games
+            else:
+                EPS = 0
+
+            total_rewards[i] = ep_rewards
+
+    # Save the Q table to be played back.
+    Q.save('Q_values.npy')
 
     # Print the running average.
     plot_running_avg(total_rewards)
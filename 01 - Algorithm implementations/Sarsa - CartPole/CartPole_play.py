@@ -1,20 +1,12 @@
+import os
+import sys
 import numpy as np
 import gym
 
-
-def action_argmax(Q, state):
-    """Return the action with the maximum value for the current state.
-
-    Arguments:
-        Q {dict} -- state-action function array
-        state {array} -- Current state
-
-    Returns:
-        int -- Action to take
-    """
-    values = np.array([Q[state, a] for a in range(N_ACTIONS)])
-    action = np.argmax(values)
-    return action
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir))
+from tabular_cartpole.q_table import QTable  # noqa: E402
+from tabular_cartpole.discretizer import Discretizer  # noqa: E402
 
 
 # Discretize the state spaces
@@ -22,38 +14,34 @@ pole_theta_space = np.linspace(-0.209, 0.209, 10)
 pole_theta_vel_space = np.linspace(-4, 4, 10)
 cart_pos_space = np.linspace(-2.4, 2.4, 10)
 cart_vel_space = np.linspace(-4, 4, 10)
+discretizer = Discretizer(cart_pos_space, cart_vel_space, pole_theta_space,
+                          pole_theta_vel_space)
 
 
 def get_state(observation):
     """Return the state based on the observation from the env
 
     Arguments:
-        observation {array} -- states from the env.
+        observation {array} -- states from the env, or an (N, 4) batch of
+            them.
 
     Returns:
-        array -- current state
+        int -- flat index of the current state, or array of the N indices
     """
-    cart_x, cart_vel, pole_theta, pole_vel = observation
-    cart_x = int(np.digitize(cart_x, cart_pos_space))
-    cart_vel = int(np.digitize(cart_vel, cart_vel_space))
-    pole_theta = int(np.digitize(pole_theta, pole_theta_space))
-    pole_vel = int(np.digitize(pole_vel, pole_theta_vel_space))
-
-    return (cart_x, cart_vel, pole_theta, pole_vel)
+    return discretizer(observation)
 
 
 if __name__ == '__main__':
 
     env = gym.make('CartPole-v0')
-    N_ACTIONS = env.action_space.n
 
     # Load the trained Q function
-    Q = np.load('Q_values.npy', allow_pickle='TRUE').item()
+    Q = QTable.load('Q_values.npy')
 
     # Play a game of Cart Pole
     observation = env.reset()
     state = get_state(observation)
-    action = action_argmax(Q, state)
+    action = Q.argmax(state)
 
     done = 0
     ep_rewards = 0
@@ -62,7 +50,7 @@ if __name__ == '__main__':
         observation, reward, done, info = env.step(action)
         ep_rewards += reward
         state = get_state(observation)
-        action = action_argmax(Q, state)
+        action = Q.argmax(state)
         env.render()
 
     print(ep_rewards)
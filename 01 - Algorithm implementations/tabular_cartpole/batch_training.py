@@ -0,0 +1,150 @@
+import numpy as np
+
+from tabular_cartpole.cartpole import BatchCartPole
+from tabular_cartpole.q_table import random_argmax
+
+
+class RandomStreams:
+    def __init__(self, seeds, chunk=4096):
+        """Independent streams of uniform draws, one per seed, drawn from
+        each stream by chunks so that a call costs a slice rather than one
+        generator call per stream.
+
+        Every call draws as many numbers from each stream, so the draws of
+        a stream only depend on its seed and on the sequence of calls.
+
+        Arguments:
+            seeds {list} -- Seed, or SeedSequence, of each stream
+            chunk {int} -- Numbers drawn from each stream at once
+        """
+        self.rngs = [np.random.default_rng(seed) for seed in seeds]
+        self.chunk = chunk
+        self._buffer = np.empty((len(self.rngs), 0))
+        self._pos = 0
+
+    def random(self, n):
+        """Return the next n draws of each stream, as an (n_streams, n)
+        array."""
+        if self._pos + n > self._buffer.shape[1]:
+            size = max(self.chunk, n)
+            fresh = np.stack([rng.random(size) for rng in self.rngs])
+            self._buffer = np.concatenate(
+                [self._buffer[:, self._pos:], fresh], axis=1)
+            self._pos = 0
+        draws = self._buffer[:, self._pos:self._pos + n]
+        self._pos += n
+        return draws
+
+
+def train_batched(tables, update, get_state, number_games, eps, eps_decay,
+                  n_envs=1, n_seeds=1, on_policy=False, seed=None):
+    """Train n_seeds independent tabular agents, each on its own n_envs
+    CartPole envs, all of them played at once by a BatchCartPole. An
+    iteration steps every env and applies their updates together.
+
+    With several seeds, the tables are the (n_seeds,) + state shape QTables
+    of all the agents and the states of a seed's envs are offset to its
+    rows. Each seed has its own epsilon and its own random streams, for the
+    initial states of its envs and for its exploration, spawned from `seed`
+    and its index: the curve of a seed doesn't depend on n_seeds.
+
+    The actions are e-greedy with respect to the sum of the `tables`, and
+    the algorithm is given by `update`, called on every step as
+    update(state, action, reward, state_, action_, eps, random) with the
+    arrays of the transitions of the envs of the seeds still learning.
+    action_ is the e-greedy action of state_ when `on_policy`, which is then
+    played on the next step, and None otherwise. eps is the epsilon of each
+    env and random(*shape) returns uniform draws of shape (n,) + shape from
+    the stream of each env's seed.
+
+    Arguments:
+        tables {list} -- QTables the actions are chosen from
+        update {function} -- Update of the tables by the algorithm
+        get_state {function} -- Flat state indices of a batch of
+            observations
+        number_games {int} -- Number of episodes of each seed
+        eps {float} -- Epsilon of the first episode
+        eps_decay {float} -- Decrease of epsilon after each episode
+        n_envs {int} -- Number of envs of each seed
+        n_seeds {int} -- Number of independent agents
+        on_policy {bool} -- Whether the next actions are chosen before the
+            update, as Sarsa does
+        seed {int} -- Seed of the random streams, drawn from the OS if None
+
+    Returns:
+        array -- (n_seeds, number_games) reward of each episode of each
+            seed, in the order they ended
+    """
+    n_actions = tables[0].n_actions
+    n = n_seeds * n_envs
+    # The seed of each env, whose rows it reads and updates.
+    agent = np.repeat(np.arange(n_seeds), n_envs)
+    offset = agent * (tables[0].n_states // n_seeds)
+
+    env_seeds, explore_seeds = [], []
+    for seed_seq in np.random.SeedSequence(seed).spawn(n_seeds):
+        env_seq, explore_seq = seed_seq.spawn(2)
+        env_seeds += env_seq.spawn(n_envs)
+        explore_seeds.append(explore_seq)
+    env = BatchCartPole(n, env_seeds)
+    streams = RandomStreams(explore_seeds)
+
+    def random(*shape):
+        size = n_envs * int(np.prod(shape))
+        return streams.random(size).reshape((n,) + shape)
+
+    eps = np.full(n_seeds, float(eps))
+    total_rewards = np.zeros((n_seeds, number_games))
+    ep_rewards = np.zeros(n)
+    games = np.zeros(n_seeds, dtype=np.int64)
+    # The seeds which played all their games stop learning.
+    learning = np.ones(n_seeds, dtype=np.bool_)
+
+    def choose_actions(state):
+        # e-greedy action selection
+        greedy = random() < (1 - eps[agent])
+        values = sum(Q.values[state] for Q in tables)
+        return np.where(greedy, random_argmax(values, random(n_actions)),
+                        (random() * n_actions).astype(np.int64))
+
+    state = offset + get_state(env.reset())
+    action = choose_actions(state)
+
+    while learning.any():
+        observation_, reward, done = env.step(action)
+        ep_rewards += reward
+        state_ = offset + get_state(observation_)
+        action_ = choose_actions(state_) if on_policy else None
+
+        envs = learning[agent]
+        update(state[envs], action[envs], reward[envs], state_[envs],
+               None if action_ is None else action_[envs], eps[agent][envs],
+               lambda *shape: random(*shape)[envs])
+
+        # Record the episodes which ended, in the order of the envs of each
+        # seed, epsilon decreasing after each of them as in the single env
+        # loops.
+        ended = np.flatnonzero(done & envs)
+        seeds = agent[ended]
+        counts = np.bincount(seeds, minlength=n_seeds)
+        rank = np.arange(len(ended)) - (np.cumsum(counts) - counts)[seeds]
+        slot = games[seeds] + rank
+        kept = slot < number_games
+        total_rewards[seeds[kept], slot[kept]] = ep_rewards[ended[kept]]
+        n_kept = np.bincount(seeds[kept], minlength=n_seeds)
+        games += n_kept
+        eps = np.maximum(eps - n_kept * eps_decay, 0)
+        learning = games < number_games
+        ep_rewards[done] = 0
+
+        state = state_
+        state[done] = offset[done] + get_state(env.reset(done))[done]
+        # Drawn even without ended episodes, for the streams to advance the
+        # same on every step whatever the other seeds do.
+        if on_policy:
+            action = action_
+            action[done] = choose_actions(state)[done]
+        else:
+            action = choose_actions(state)
+
+    return total_rewards
@@ -0,0 +1,79 @@
+import numpy as np
+
+# Physics of gym's CartPole-v0.
+GRAVITY = 9.8
+MASS_CART = 1.0
+MASS_POLE = 0.1
+TOTAL_MASS = MASS_CART + MASS_POLE
+LENGTH = 0.5  # Half the pole's length
+POLE_MASS_LENGTH = MASS_POLE * LENGTH
+FORCE_MAG = 10.0
+TAU = 0.02  # Seconds between state updates
+THETA_THRESHOLD = 12 * 2 * np.pi / 360
+X_THRESHOLD = 2.4
+MAX_EPISODE_STEPS = 200
+
+
+class BatchCartPole:
+    def __init__(self, n_envs, seed=None):
+        """`n_envs` CartPole-v0 envs stepped in lockstep as numpy arrays, with
+        the dynamics, termination and 200 steps limit of gym's.
+
+        Observations are (n_envs, 4) arrays of the cart position, cart
+        velocity, pole angle and pole angular velocity, and actions (n_envs,)
+        arrays of 0 (push left) or 1 (push right).
+
+        Arguments:
+            n_envs {int} -- Number of envs
+            seed {int or list} -- Seed of the random initial states, or
+                the seed (or SeedSequence) of each env for them to draw
+                from their own stream
+        """
+        self.n_envs = n_envs
+        if seed is None or np.isscalar(seed):
+            seed = np.random.SeedSequence(seed).spawn(n_envs)
+        self.rngs = [np.random.default_rng(s) for s in seed]
+        self.state = np.zeros((n_envs, 4))
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+
+    def reset(self, mask=None):
+        """Reset all the envs, or those where `mask` is True.
+
+        Returns:
+            array -- Observations of all the envs
+        """
+        if mask is None:
+            mask = np.ones(self.n_envs, dtype=np.bool_)
+        for i in np.flatnonzero(mask):
+            self.state[i] = self.rngs[i].uniform(-0.05, 0.05, 4)
+        self.steps[mask] = 0
+        return self.state.copy()
+
+    def step(self, actions):
+        """Step every env. The envs whose episode is done must be reset
+        before the next step.
+
+        Returns:
+            tuple -- Observations, rewards and done flags of the envs
+        """
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(actions == 1, FORCE_MAG, -FORCE_MAG)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+        temp = (force + POLE_MASS_LENGTH * theta_dot ** 2 * sintheta) / \
+            TOTAL_MASS
+        thetaacc = (GRAVITY * sintheta - costheta * temp) / (
+            LENGTH * (4.0 / 3.0 - MASS_POLE * costheta ** 2 / TOTAL_MASS))
+        xacc = temp - POLE_MASS_LENGTH * thetaacc * costheta / TOTAL_MASS
+
+        # Euler integration, in gym's order.
+        self.state = np.stack([x + TAU * x_dot,
+                               x_dot + TAU * xacc,
+                               theta + TAU * theta_dot,
+                               theta_dot + TAU * thetaacc], axis=1)
+        self.steps += 1
+
+        x, theta = self.state[:, 0], self.state[:, 2]
+        dones = (np.abs(x) > X_THRESHOLD) | (np.abs(theta) > THETA_THRESHOLD)
+        dones |= self.steps >= MAX_EPISODE_STEPS
+        return self.state.copy(), np.ones(self.n_envs), dones
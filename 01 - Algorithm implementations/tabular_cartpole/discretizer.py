@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class Discretizer:
+    def __init__(self, *spaces):
+        """Map observations to flat state indices, each observation being
+        digitized with the bins of its space as np.digitize does.
+
+        The bin index of an observation is the number of bins it's greater
+        or equal to, so the flat index is a dot product of the comparisons
+        with the row-major strides, computed for a whole batch at once.
+
+        Arguments:
+            spaces {array} -- Increasing bins of each observation, in the
+                order of the observations
+        """
+        n_bins = max(len(space) for space in spaces)
+        # Missing bins are +inf, which no observation reaches.
+        self.edges = np.full((len(spaces), n_bins), np.inf)
+        for i, space in enumerate(spaces):
+            self.edges[i, :len(space)] = space
+        self.shape = tuple(len(space) + 1 for space in spaces)
+        strides = np.cumprod((self.shape[1:] + (1,))[::-1])[::-1]
+        self._weights = np.repeat(strides, n_bins).astype(np.float64)
+        # Comparisons of a single observation, reused by every call.
+        self._cmp = np.empty(self.edges.shape)
+
+    def __call__(self, observations):
+        """Return the flat state index of an observation, or an array of
+        them for an (N, n_observations) batch.
+
+        Arguments:
+            observations {array} -- Observation or batch of observations
+
+        Returns:
+            int or array -- Flat state indices
+        """
+        observations = np.asarray(observations)
+        if observations.ndim == 1:
+            np.greater_equal(observations[:, None], self.edges, out=self._cmp)
+            return int(self._cmp.ravel().dot(self._weights))
+        cmp = observations[:, :, None] >= self.edges
+        return cmp.reshape(len(observations), -1).dot(
+            self._weights).astype(np.int64)
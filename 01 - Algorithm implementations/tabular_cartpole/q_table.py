@@ -0,0 +1,136 @@
+import numpy as np
+
+# Each of the 4 observations is digitized with 10 bins, giving 11 indices.
+STATE_SHAPE = (11, 11, 11, 11)
+
+
+def random_argmax(values, keys=None):
+    """Return the index of the maximum of each row, ties broken randomly.
+
+    Arguments:
+        values {array} -- (..., n_actions) action values
+        keys {array} -- Uniform draws of the shape of values breaking the
+            ties, drawn from np.random if None
+
+    Returns:
+        array -- Index of the maximum of each row
+    """
+    if keys is None:
+        keys = np.random.random(values.shape)
+    is_max = values == values.max(axis=-1, keepdims=True)
+    # The largest of random keys drawn for the maximum values only.
+    return np.argmax((keys + 1) * is_max, axis=-1)
+
+
+class QTable:
+    def __init__(self, n_actions, state_shape=STATE_SHAPE):
+        """State-action values stored in a contiguous array of shape
+        state_shape + (n_actions,).
+
+        States are addressed by their flat index, as given by state_index(),
+        through `values`, a (n_states, n_actions) view of `table`.
+
+        Arguments:
+            n_actions {int} -- Number of actions
+            state_shape {tuple} -- Number of bins of each observation
+        """
+        self.n_actions = n_actions
+        self.state_shape = tuple(state_shape)
+        self.table = np.zeros(self.state_shape + (n_actions,))
+        self.values = self.table.reshape(-1, n_actions)
+
+    @property
+    def n_states(self):
+        return len(self.values)
+
+    def state_index(self, state):
+        """Return the flat index of a tuple of bin indices.
+
+        Arguments:
+            state {tuple} -- Bin index of each observation
+
+        Returns:
+            int -- Flat state index
+        """
+        return int(np.ravel_multi_index(state, self.state_shape))
+
+    def argmax(self, state):
+        """Return the action with the maximum value, ties broken randomly.
+
+        Arguments:
+            state {int} -- Flat state index
+
+        Returns:
+            int -- Action to take
+        """
+        row = self.values[state]
+        best = np.flatnonzero(row == row.max())
+        if len(best) == 1:
+            return int(best[0])
+        return int(np.random.choice(best))
+
+    def argmax_batch(self, states):
+        """Return the action with the maximum value of each state, ties
+        broken randomly.
+
+        Arguments:
+            states {array} -- Flat state indices
+
+        Returns:
+            array -- Actions to take
+        """
+        return random_argmax(self.values[states])
+
+    def update(self, state, action, target, alpha):
+        """Move Q(s,a) towards the TD target in place.
+
+        Arguments:
+            state {int} -- Flat state index
+            action {int} -- Action taken
+            target {float} -- TD target
+            alpha {float} -- Step size
+        """
+        self.values[state, action] += alpha * (target -
+                                               self.values[state, action])
+
+    def update_batch(self, states, actions, targets, alpha):
+        """Move each Q(s,a) towards its TD target in place.
+
+        A state-action pair present k times in the batch moves towards the
+        mean of its k targets with the step 1-(1-alpha)^k of k sequential
+        updates, so Q stays between its old value and the targets whatever
+        the batch size.
+
+        Arguments:
+            states {array} -- Flat state indices
+            actions {array} -- Actions taken
+            targets {array} -- TD targets
+            alpha {float} -- Step size
+        """
+        pairs = np.asarray(states) * self.n_actions + np.asarray(actions)
+        pairs, inverse, counts = np.unique(pairs, return_inverse=True,
+                                           return_counts=True)
+        mean_targets = np.bincount(inverse, weights=targets,
+                                   minlength=len(pairs)) / counts
+        values = self.values.reshape(-1)
+        values[pairs] += (1 - (1 - alpha) ** counts) * (mean_targets -
+                                                        values[pairs])
+
+    def save(self, path):
+        np.save(path, self.table)
+
+    @classmethod
+    def load(cls, path):
+        """Load a table saved by save(), or a Q dictionary keyed by
+        (state, action) as the scripts used to save."""
+        saved = np.load(path, allow_pickle=True)
+        if saved.dtype != object:
+            q_table = cls(saved.shape[-1], saved.shape[:-1])
+            q_table.table[...] = saved
+            return q_table
+        saved = saved.item()
+        n_actions = max(action for _, action in saved) + 1
+        q_table = cls(n_actions)
+        for (state, action), value in saved.items():
+            q_table.table[state + (action,)] = value
+        return q_table